@@ -0,0 +1,225 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from anthropic import AsyncAnthropic, AnthropicError
+from agents.retrieval_new import retrieve_errors, extract_error_phrase
+from agents.speculation import start_speculation, speculation_stats
+from agents.llm_breaker import LLM_BREAKER, LLMUnavailable, guarded_create, maybe_probe
+from agents.rate_limiter import INTERACTIVE, SUGGESTION
+
+MODEL = "claude-3-haiku-20240307"
+
+# Whole-turn budget: first completion, tool calls and fallback suggestions together
+TURN_DEADLINE_SECONDS = float(os.getenv("CHAT_TURN_DEADLINE_SECONDS", "30"))
+# SQLite + fuzzy matching run here so they never block the event loop
+RETRIEVAL_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv("RETRIEVAL_WORKERS", "8")),
+    thread_name_prefix="retrieval"
+)
+# Keep SDK retries short; the circuit breaker handles sustained failures
+ANTHROPIC_MAX_RETRIES = int(os.getenv("ANTHROPIC_MAX_RETRIES", "1"))
+
+CONSULT_SYSTEM = "You are an SAP consultant. Provide 1-2 concise, practical suggestions (transaction codes, checks, steps). Do NOT mention databases or escalation."
+NO_MATCH_SYSTEM = "You are an SAP consultant. Provide 1-2 concise, practical suggestions. No mention of DB/escalation."
+DB_ERROR_SYSTEM = "You are an SAP consultant. Provide 1-2 concise suggestions."
+TIMEOUT_MESSAGE = "Sorry, that took too long to look up. Please try again in a moment."
+# Degraded (KB-only) mode while the LLM circuit is open
+DEGRADED_NOTICE = "_Our AI assistant is temporarily unavailable, so I've searched the knowledge base directly._"
+CANNED_GUIDANCE = "Check the master data involved (e.g. MM03 for materials, XK03 for vendors, KS03 for cost centers) and confirm your authorizations with SU53."
+
+# One event loop per process, shared by every Streamlit session (keeps the HTTP pool warm)
+_loop = None
+_loop_lock = threading.Lock()
+_clients = {}
+
+
+def get_loop():
+    """Return the background event loop, starting its thread on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="chat-core-loop", daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def get_client(api_key):
+    """Return the process-wide AsyncAnthropic client for api_key."""
+    with _loop_lock:
+        if api_key not in _clients:
+            _clients[api_key] = AsyncAnthropic(api_key=api_key, max_retries=ANTHROPIC_MAX_RETRIES)
+        return _clients[api_key]
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call (SQLite, fuzzy matching) on the retrieval pool."""
+    return await asyncio.get_running_loop().run_in_executor(RETRIEVAL_POOL, partial(func, *args, **kwargs))
+
+
+async def _suggest(client, system, prompt, default, deadline):
+    """Ask the model for 1-2 fallback suggestions (canned guidance if it is unavailable)."""
+    try:
+        suggestion_resp = await guarded_create(
+            client,
+            deadline,
+            priority=SUGGESTION,
+            model=MODEL,
+            max_tokens=200,
+            temperature=0.7,
+            system=system,
+            messages=[{"role": "user", "content": f"User query: {prompt}"}]
+        )
+    except LLMUnavailable as e:
+        print(f"Debug: suggestion skipped, LLM unavailable: {e}")
+        return CANNED_GUIDANCE
+    return suggestion_resp.content[0].text if suggestion_resp.content else default
+
+
+def _reply(text, history=None, **state):
+    """A rendered assistant message plus the session_state updates it implies."""
+    return {"markdown": text, "history": text if history is None else history, "state": state}
+
+
+async def _handle_retrieve_errors(client, tool_input, prompt, deadline, speculation=None, model_requested=True):
+    """Run one retrieve_errors tool call and build the assistant's reply.
+
+    model_requested=False (KB-only mode) still reuses a speculative lookup but
+    keeps it out of the speculation hit/miss stats.
+    """
+    try:
+        result = await speculation.take(tool_input, count=model_requested) if speculation else None
+        if result is None:
+            result = await run_blocking(retrieve_errors, **tool_input)
+    except Exception as e:
+        print(f"Debug: retrieve_errors error: {e}")
+        suggestion = await _suggest(client, DB_ERROR_SYSTEM, prompt, "Check relevant T-codes.", deadline)
+        return _reply(f"Error searching DB. Suggestion: {suggestion} Escalate?")
+
+    if not (isinstance(result, list) and result):
+        # No match → LLM suggestion
+        suggestion = await _suggest(client, NO_MATCH_SYSTEM, prompt, "Check transaction codes or master data.", deadline)
+        return _reply(f"Sorry, no match found. Based on my SAP expertise: {suggestion} Would you like to escalate?",
+                      last_matches=None, last_user_error=None)
+
+    result = sorted(result, key=lambda x: x["score"], reverse=True)
+    state = {"last_matches": result, "last_user_error": tool_input["user_input"]}
+    top = result[0]
+
+    if top.get("solutiontype", "").lower() in ["", "consult", "user guidance"]:
+        suggestion = await _suggest(client, CONSULT_SYSTEM, prompt, "Check relevant transaction codes or master data.", deadline)
+        return _reply(f"Sorry, I couldn’t find a match in my database. Based on my SAP expertise: {suggestion} Would you like to escalate?",
+                      **state)
+
+    if "escalation" in top.get("solutiontype", "").lower():
+        state["pending_details"] = {
+            "user_input": prompt,
+            "matches": result,
+            "extracted_phrase": extract_error_phrase(prompt)
+        }
+        return _reply(f"**Try this first:**\n\n{top['solution']}\n\n**Still needs escalation.** Please provide contact details.",
+                      "This issue requires escalation. Please provide contact details.", **state)
+
+    return _reply(f"Looks like you're facing **{top['issuename']}**. Here's how to resolve it:\n\n{top['solution']}", **state)
+
+
+async def _handle_block(client, block, prompt, deadline, speculation):
+    try:
+        if block.type == "text":
+            return _reply(block.text)
+        if block.type == "tool_use":
+            print(f"Debug: Tool call → {block.name}: {block.input}")
+            if block.name == "retrieve_errors":
+                return await _handle_retrieve_errors(client, block.input, prompt, deadline, speculation)
+        return None
+    except AnthropicError as e:
+        return {"error": str(e)}
+
+
+async def handle_turn(client, prompt, system_prompt, tools, deadline_seconds=TURN_DEADLINE_SECONDS):
+    """Answer one chat message; returns the replies in the order Claude produced them.
+
+    Independent tool calls (and their fallback completions) run concurrently,
+    all bounded by one per-turn deadline. Each reply is either
+    {"markdown", "history", "state"} or {"error"}.
+    """
+    deadline = time.monotonic() + deadline_seconds
+    loop = asyncio.get_running_loop()
+    # Start retrieval while the model is still thinking; reused if it asks for the same lookup
+    speculation = start_speculation(prompt, partial(loop.run_in_executor, RETRIEVAL_POOL))
+    try:
+        if not LLM_BREAKER.allow():
+            maybe_probe(client)
+            return await _degraded_answer(client, prompt, deadline, speculation)
+        return await _answer(client, prompt, system_prompt, tools, deadline, speculation)
+    finally:
+        if speculation:
+            speculation.close()
+            print(f"Debug: speculation stats: {speculation_stats()}")
+
+
+async def _degraded_answer(client, prompt, deadline, speculation):
+    """Answer straight from retrieve_errors when the LLM is unavailable."""
+    print("Debug: LLM unavailable, answering from the knowledge base only")
+    try:
+        reply = await asyncio.wait_for(
+            _handle_retrieve_errors(client, {"user_input": prompt}, prompt, deadline, speculation, model_requested=False),
+            max(0.0, deadline - time.monotonic())
+        )
+    except asyncio.TimeoutError:
+        reply = _reply(TIMEOUT_MESSAGE)
+    reply["markdown"] = f"{DEGRADED_NOTICE}\n\n{reply['markdown']}"
+    return [reply]
+
+
+async def _answer(client, prompt, system_prompt, tools, deadline, speculation):
+    try:
+        response = await guarded_create(
+            client,
+            deadline,
+            priority=INTERACTIVE,
+            model=MODEL,
+            max_tokens=500,
+            temperature=0.7,
+            system=system_prompt,
+            messages=[{"role": "user", "content": prompt}],
+            tools=tools
+        )
+    except LLMUnavailable as e:
+        print(f"Debug: Anthropic call failed ({e}), falling back to KB-only answer")
+        return await _degraded_answer(client, prompt, deadline, speculation)
+    except AnthropicError as e:
+        return [{"error": str(e)}]
+    print(f"Debug: Anthropic response: {response}")
+
+    tasks = [asyncio.ensure_future(_handle_block(client, block, prompt, deadline, speculation))
+             for block in response.content]
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()))
+        for task in pending:
+            task.cancel()
+        # cancel() only schedules it; let the tasks finish so their state can be read below
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    replies = []
+    for task in tasks:
+        if task.cancelled():
+            replies.append(_reply(TIMEOUT_MESSAGE))
+        elif task.exception() is not None:
+            print(f"Debug: chat block failed: {task.exception()}")
+            replies.append({"error": str(task.exception())})
+        elif task.result() is not None:
+            replies.append(task.result())
+    return replies
+
+
+def run_chat_turn(client, prompt, system_prompt, tools, deadline_seconds=TURN_DEADLINE_SECONDS):
+    """Blocking entry point for the Streamlit script thread."""
+    future = asyncio.run_coroutine_threadsafe(
+        handle_turn(client, prompt, system_prompt, tools, deadline_seconds), get_loop()
+    )
+    # The coroutine enforces the deadline itself; the margin only guards against a wedged loop
+    return future.result(timeout=deadline_seconds + 5)
@@ -0,0 +1,93 @@
+import os
+import re
+import threading
+import time
+
+# Escalations for the same KB match, entity codes and company/profit center within
+# this window are folded into the first ticket instead of opening a new one.
+COALESCE_WINDOW_SECONDS = int(os.getenv("ESCALATION_COALESCE_WINDOW_SECONDS", "1800"))
+# How long a later reporter waits for the first reporter's helpdesk call to finish
+COALESCE_WAIT_SECONDS = int(os.getenv("ESCALATION_COALESCE_WAIT_SECONDS", "30"))
+
+# SAP-style codes: material numbers, plants, cost centers (e.g. 0001000738, NG70, MA108)
+ENTITY_CODE_PATTERN = re.compile(r"\b(?=[A-Za-z0-9-]*\d)[A-Za-z0-9-]{2,}\b")
+
+# key -> group dict, shared by all Streamlit sessions in this process
+ESCALATION_GROUPS = {}
+_groups_lock = threading.Lock()
+
+
+def extract_entity_codes(text):
+    """Return the sorted, normalized entity codes mentioned in text."""
+    if not text:
+        return ()
+    codes = set()
+    for code in ENTITY_CODE_PATTERN.findall(text):
+        code = code.upper()
+        if code.isdigit():
+            code = code.lstrip('0') or '0'  # 0001000738 and 1000738 are the same material
+        codes.add(code)
+    return tuple(sorted(codes))
+
+
+def coalesce_key(user_input, top_match, company_code, profit_center):
+    """Build the grouping key for an escalation, or None if it should not be coalesced."""
+    if not top_match or top_match.get("id") is None or not top_match.get("score"):
+        return None  # only collapse escalations that hit the same KB entry
+    return (
+        top_match["id"],
+        extract_entity_codes(user_input),
+        str(company_code or ""),
+        str(profit_center or "")
+    )
+
+
+def _purge_expired(now):
+    expired = [key for key, group in ESCALATION_GROUPS.items()
+               if now - group["created"] > COALESCE_WINDOW_SECONDS]
+    for key in expired:
+        del ESCALATION_GROUPS[key]
+
+
+def join_escalation(key):
+    """Join the group for key, creating it if needed.
+
+    Returns (group, is_leader). The leader sends the helpdesk ticket and must
+    call publish_ticket(); everyone else calls wait_for_ticket().
+    """
+    now = time.monotonic()
+    with _groups_lock:
+        _purge_expired(now)
+        group = ESCALATION_GROUPS.get(key)
+        if group is None:
+            group = {
+                "created": now,
+                "ready": threading.Event(),
+                "response": None,
+                "reporters": 1
+            }
+            ESCALATION_GROUPS[key] = group
+            return group, True
+        group["reporters"] += 1
+        return group, False
+
+
+def publish_ticket(key, group, api_response):
+    """Record the leader's helpdesk response and release any waiting reporters.
+
+    A failed call (no issue_number) drops the group so the next reporter retries.
+    """
+    with _groups_lock:
+        group["response"] = api_response
+        if not api_response.get("issue_number") and ESCALATION_GROUPS.get(key) is group:
+            del ESCALATION_GROUPS[key]
+    group["ready"].set()
+
+
+def wait_for_ticket(group, timeout=COALESCE_WAIT_SECONDS):
+    """Wait for the leader's ticket; return its api_response, or None if none was created."""
+    if not group["ready"].wait(timeout):
+        print("Warning: timed out waiting for coalesced escalation ticket")
+        return None
+    response = group["response"]
+    return response if response and response.get("issue_number") else None
@@ -0,0 +1,222 @@
+import bisect
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+from array import array
+
+# Snapshot file layout (native byte order, sections 8-byte aligned):
+#   magic (8 bytes) | format version (u32) | directory length (u32) | directory (JSON)
+#   then the body, whose sections (offsets in the directory are body-relative) are:
+#   ids (int64, sorted) | logcategory (int64) | logsubcategory (int64)
+#   | name_offsets (uint32, rows + 1) | names (UTF-8 normalized issuenames)
+#   | keyword_rows (uint32 row positions, grouped per keyword)
+MAGIC = b"SAPKBSN\0"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("=8sII")
+NULL_INT = -(2 ** 63)  # stands in for NULL logcategory/logsubcategory
+
+# Keywords retrieve_errors filters on with issuename LIKE '%keyword%'
+FILTER_KEYWORDS = ['material', 'plant', 'vendor', 'company', 'code', 'bank', 'details', 'missing', 'not', 'in']
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+DB_PATH = os.path.join(DATA_DIR, "errors.db")
+SNAPSHOT_PATH = os.path.join(DATA_DIR, "errors.kbsnap")
+
+
+def normalize_issuename(issuename):
+    """Normalize an issuename for fuzzy matching (placeholders removed)."""
+    return (issuename or "").lower().replace('xxxx', '').replace('yyyy', '')
+
+
+def source_fingerprint(db_path):
+    """Identify the database a snapshot was built from (size + mtime)."""
+    stat = os.stat(db_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _pad(buf):
+    buf.extend(b"\0" * (-len(buf) % 8))
+
+
+def build_snapshot(db_path=DB_PATH, snapshot_path=SNAPSHOT_PATH):
+    """Write a versioned snapshot of the KB retrieval data from errors.db.
+
+    The file is written to a temp name and renamed, so workers never map a
+    half-written snapshot. Returns the number of rows written.
+    """
+    fingerprint = source_fingerprint(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("SELECT id, issuename, logcategory, logsubcategory FROM errors ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+    ids = array('q')
+    logcategories = array('q')
+    logsubcategories = array('q')
+    name_offsets = array('I', [0])
+    names = bytearray()
+    keyword_positions = {keyword: array('I') for keyword in FILTER_KEYWORDS}
+    for position, (error_id, issuename, logcategory, logsubcategory) in enumerate(rows):
+        ids.append(error_id)
+        logcategories.append(NULL_INT if logcategory is None else int(logcategory))
+        logsubcategories.append(NULL_INT if logsubcategory is None else int(logsubcategory))
+        names.extend(normalize_issuename(issuename).encode('utf-8'))
+        name_offsets.append(len(names))
+        # Same semantics as SQLite's case-insensitive LIKE on the raw issuename
+        lowered = (issuename or "").lower()
+        for keyword, positions in keyword_positions.items():
+            if keyword in lowered:
+                positions.append(position)
+
+    keyword_rows = array('I')
+    keyword_ranges = {}
+    for keyword, positions in keyword_positions.items():
+        keyword_ranges[keyword] = [len(keyword_rows), len(positions)]
+        keyword_rows.extend(positions)
+
+    sections = [
+        ("ids", 'q', ids.tobytes()),
+        ("logcategory", 'q', logcategories.tobytes()),
+        ("logsubcategory", 'q', logsubcategories.tobytes()),
+        ("name_offsets", 'I', name_offsets.tobytes()),
+        ("names", 'B', bytes(names)),
+        ("keyword_rows", 'I', keyword_rows.tobytes()),
+    ]
+
+    # Section offsets are relative to the body, which starts 8-byte aligned after the directory
+    body = bytearray()
+    offsets = {}
+    for name, typecode, data in sections:
+        offsets[name] = [len(body), len(data), typecode]
+        body.extend(data)
+        _pad(body)
+
+    directory = {
+        "rows": len(rows),
+        "byteorder": sys.byteorder,
+        "source": fingerprint,
+        "keywords": keyword_ranges,
+        "sections": offsets
+    }
+    dir_bytes = json.dumps(directory, sort_keys=True).encode('utf-8')
+
+    out = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, len(dir_bytes)))
+    out.extend(dir_bytes)
+    _pad(out)
+    out.extend(body)
+
+    snapshot_dir = os.path.dirname(os.path.abspath(snapshot_path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".kbsnap-", dir=snapshot_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(out)
+        # mkstemp creates the file 0600; workers may run as a different user than the build step
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, snapshot_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    print(f"KB snapshot written to {snapshot_path} ({len(rows)} rows, {len(out)} bytes)")
+    return len(rows)
+
+
+class KBSnapshot:
+    """Read-only, memory-mapped view of a KB snapshot.
+
+    Arrays are memoryviews straight into the page cache, so every worker that
+    maps the same file shares one physical copy; names are decoded per lookup.
+    """
+
+    def __init__(self, path, mapped, directory, body_start):
+        self.path = path
+        self._mmap = mapped
+        self.directory = directory
+        self.source = directory["source"]
+        view = memoryview(mapped)
+        sections = {}
+        for name, (offset, length, typecode) in directory["sections"].items():
+            section = view[body_start + offset:body_start + offset + length]
+            sections[name] = section if typecode == 'B' else section.cast(typecode)
+        self.ids = sections["ids"]
+        self.logcategory = sections["logcategory"]
+        self.logsubcategory = sections["logsubcategory"]
+        self._name_offsets = sections["name_offsets"]
+        self._names = sections["names"]
+        self._keyword_rows = sections["keyword_rows"]
+        self._keywords = directory["keywords"]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position(self, error_id):
+        """Row position of error_id, or None if it is not in the snapshot."""
+        pos = bisect.bisect_left(self.ids, error_id)
+        if pos < len(self.ids) and self.ids[pos] == error_id:
+            return pos
+        return None
+
+    def name(self, position):
+        """Normalized issuename at a row position."""
+        return str(self._names[self._name_offsets[position]:self._name_offsets[position + 1]], 'utf-8')
+
+    def normalized_issuename(self, error_id):
+        position = self.position(error_id)
+        return None if position is None else self.name(position)
+
+    def keyword_rows(self, keyword):
+        """Row positions whose issuename contains keyword (one of FILTER_KEYWORDS)."""
+        start, count = self._keywords.get(keyword, (0, 0))
+        return self._keyword_rows[start:start + count]
+
+    def is_fresh(self, db_path=DB_PATH):
+        """True if db_path is still the database this snapshot was built from."""
+        try:
+            return source_fingerprint(db_path) == self.source
+        except OSError:
+            return False
+
+
+def open_snapshot(snapshot_path=SNAPSHOT_PATH, db_path=DB_PATH):
+    """Map a snapshot file; returns None if it is missing, stale or unreadable."""
+    if not os.path.exists(snapshot_path):
+        return None
+    try:
+        with open(snapshot_path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, dir_len = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            print(f"Ignoring KB snapshot {snapshot_path}: unsupported format")
+            mapped.close()
+            return None
+        directory = json.loads(bytes(mapped[HEADER.size:HEADER.size + dir_len]))
+        if directory.get("byteorder") != sys.byteorder:
+            print(f"Ignoring KB snapshot {snapshot_path}: built on a {directory.get('byteorder')}-endian machine")
+            mapped.close()
+            return None
+        body_start = HEADER.size + dir_len
+        body_start += -body_start % 8
+        snapshot = KBSnapshot(snapshot_path, mapped, directory, body_start)
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        print(f"Cannot open KB snapshot {snapshot_path}: {e}")
+        return None
+    if db_path and not snapshot.is_fresh(db_path):
+        print(f"Ignoring KB snapshot {snapshot_path}: errors.db has changed since it was built")
+        return None
+    print(f"Mapped KB snapshot with {len(snapshot)} rows")
+    return snapshot
+
+
+if __name__ == "__main__":
+    # Build step: python -m agents.kb_snapshot [db_path] [snapshot_path]
+    db = sys.argv[1] if len(sys.argv) > 1 else DB_PATH
+    out_path = sys.argv[2] if len(sys.argv) > 2 else SNAPSHOT_PATH
+    build_snapshot(db, out_path)
+    snapshot = open_snapshot(out_path, db)
+    if snapshot is not None and len(snapshot):
+        print(f"Check: id {snapshot.ids[0]} -> {snapshot.name(0)!r}")
@@ -0,0 +1,204 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from anthropic import AnthropicError, APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+from agents.rate_limiter import RATE_LIMITER, INTERACTIVE, BACKGROUND, RateLimitTimeout, estimate_tokens
+
+# Per-call latency budget: a completion slower than this counts as a failure
+LLM_CALL_BUDGET_SECONDS = float(os.getenv("LLM_CALL_BUDGET_SECONDS", "12"))
+# Calls that could not start with at least this much of the turn deadline left are not made
+MIN_CALL_BUDGET_SECONDS = float(os.getenv("LLM_MIN_CALL_BUDGET_SECONDS", "3"))
+# Trip when at least BREAKER_FAILURE_RATE of the last BREAKER_WINDOW calls failed
+BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(os.getenv("LLM_BREAKER_FAILURE_RATE", "0.5"))
+# How long to stay open before probing the API again
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+PROBE_TIMEOUT_SECONDS = float(os.getenv("LLM_PROBE_TIMEOUT_SECONDS", "5"))
+PROBE_MODEL = "claude-3-haiku-20240307"
+# How long to hold queued calls after a 429 that carries no retry-after header
+DEFAULT_RETRY_AFTER_SECONDS = 5.0
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class LLMUnavailable(Exception):
+    """The Anthropic API is failing, too slow, or the circuit is open."""
+
+
+def is_provider_failure(error):
+    """True for errors that say the provider is unhealthy (not bad requests)."""
+    if isinstance(error, (APIConnectionError, APITimeoutError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """Failure-rate circuit breaker for outbound LLM calls.
+
+    closed: calls go through and outcomes are tracked over a sliding window.
+    open: calls are refused until the cooldown passes.
+    half_open: a single background probe decides whether to close again;
+    user traffic keeps being refused meanwhile so nobody waits on the probe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)
+        self.trips = 0
+
+    def allow(self):
+        with self._lock:
+            return self.state == CLOSED
+
+    def probe_due(self):
+        """Move open -> half_open once the cooldown has passed; True if the caller should probe."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN_SECONDS:
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                print("LLM circuit closed: API recovered")
+                self.state = CLOSED
+                self.outcomes.clear()
+            self.outcomes.append(True)
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trip()
+                return
+            self.outcomes.append(False)
+            failures = self.outcomes.count(False)
+            if (self.state == CLOSED and len(self.outcomes) >= BREAKER_MIN_CALLS
+                    and failures / len(self.outcomes) >= BREAKER_FAILURE_RATE):
+                self._trip()
+
+    def _trip(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        print(f"LLM circuit open: degraded (KB-only) mode for {BREAKER_COOLDOWN_SECONDS:.0f}s")
+
+    def abandon_probe(self):
+        """Back to open if a probe ended without recording an outcome; the next cooldown probes again."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                print("LLM probe gave no answer; circuit stays open")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "trips": self.trips,
+                "recent_calls": len(self.outcomes),
+                "recent_failures": self.outcomes.count(False)
+            }
+
+
+# Shared by every session in the process
+LLM_BREAKER = CircuitBreaker()
+_probe_task = None
+
+
+def _retry_after(error):
+    try:
+        return float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER_SECONDS
+
+
+async def _settle_usage(estimated, response):
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        await RATE_LIMITER.settle(estimated, (usage.input_tokens or 0) + (usage.output_tokens or 0))
+
+
+def _check_time_left(deadline):
+    # Not the provider's fault, so the breaker is left alone
+    if deadline - time.monotonic() < MIN_CALL_BUDGET_SECONDS:
+        raise LLMUnavailable("not enough time left in the turn to call the LLM")
+
+
+async def guarded_create(client, deadline, priority=INTERACTIVE, **kwargs):
+    """client.messages.create behind the breaker, the rate limiter and the per-call latency budget.
+
+    Raises LLMUnavailable when the circuit is open, the rate-limit queue cannot
+    serve the call with MIN_CALL_BUDGET_SECONDS still left before the deadline,
+    or the provider fails/times out; other API errors (e.g. bad requests) are
+    raised unchanged. Only provider failures are recorded by the breaker.
+    """
+    if not LLM_BREAKER.allow():
+        raise LLMUnavailable("LLM circuit is open")
+    _check_time_left(deadline)
+    estimated = estimate_tokens(kwargs)
+    try:
+        waited = await RATE_LIMITER.acquire(estimated, priority, deadline - MIN_CALL_BUDGET_SECONDS)
+    except RateLimitTimeout as e:
+        raise LLMUnavailable(str(e)) from e
+    if waited > 0.05:
+        print(f"Debug: waited {waited * 1000:.0f} ms for rate limit (priority {priority}), "
+              f"queue depth {RATE_LIMITER.snapshot()['queue_depth']}")
+    _check_time_left(deadline)
+    budget = min(LLM_CALL_BUDGET_SECONDS, deadline - time.monotonic())
+    try:
+        response = await asyncio.wait_for(client.messages.create(timeout=budget, **kwargs), budget)
+    except (AnthropicError, asyncio.TimeoutError) as e:
+        if isinstance(e, RateLimitError):
+            await RATE_LIMITER.pause(_retry_after(e))
+        if not is_provider_failure(e):
+            raise
+        if budget < LLM_CALL_BUDGET_SECONDS and isinstance(e, (APITimeoutError, asyncio.TimeoutError)):
+            # The turn deadline (e.g. after queueing) cut the budget short; a timeout says nothing about the provider
+            raise LLMUnavailable("LLM call ran out of turn time") from e
+        LLM_BREAKER.record_failure()
+        raise LLMUnavailable(str(e) or "LLM call timed out") from e
+    await _settle_usage(estimated, response)
+    LLM_BREAKER.record_success()
+    return response
+
+
+async def _probe(client):
+    probe = {"model": PROBE_MODEL, "max_tokens": 1, "messages": [{"role": "user", "content": "ping"}]}
+    try:
+        try:
+            await RATE_LIMITER.acquire(estimate_tokens(probe), BACKGROUND, time.monotonic() + PROBE_TIMEOUT_SECONDS)
+        except RateLimitTimeout:
+            print("LLM probe skipped: rate limit queue is full")
+            return
+        try:
+            await asyncio.wait_for(client.messages.create(timeout=PROBE_TIMEOUT_SECONDS, **probe), PROBE_TIMEOUT_SECONDS)
+        except (AnthropicError, asyncio.TimeoutError) as e:
+            if is_provider_failure(e):
+                print(f"LLM probe failed: {e}")
+                LLM_BREAKER.record_failure()
+                return
+        LLM_BREAKER.record_success()  # any answer that isn't a provider failure means the API is back
+    except Exception as e:
+        print(f"LLM probe crashed: {e!r}")
+    finally:
+        # Skipped, cancelled or crashed without an outcome: never leave the breaker half-open
+        LLM_BREAKER.abandon_probe()
+
+
+def maybe_probe(client):
+    """Fire a background recovery probe if the breaker's cooldown has elapsed."""
+    global _probe_task
+    if LLM_BREAKER.probe_due():
+        print("LLM circuit half-open: probing API")
+        # Keep a reference so the task cannot be garbage-collected mid-probe
+        _probe_task = asyncio.ensure_future(_probe(client))
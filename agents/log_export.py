@@ -0,0 +1,312 @@
+import codecs
+import json
+import os
+import sys
+import uuid
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+from agents.log_raiser import LOG_PATH
+
+# Parquet dataset of escalations, hive-partitioned as month=YYYY-MM/company=<code>/part-*.parquet
+ANALYTICS_DIR = os.getenv(
+    "ESCALATION_ANALYTICS_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "escalations")
+)
+# Byte offset in logs.json up to which records have been exported
+WATERMARK_FILE = "_watermark.json"
+# Compact a partition once it has this many small part files
+COMPACT_MIN_FILES = int(os.getenv("ESCALATION_COMPACT_MIN_FILES", "8"))
+READ_CHUNK_BYTES = 1 << 20
+
+# retrieve_errors keeps matches scoring >= 65; 0 is its "no matching error" placeholder
+SCORE_BANDS = [(90, "90-100"), (80, "80-89"), (65, "65-79"), (1, "<65"), (0, "no match")]
+
+# Bump when SCHEMA changes; a dataset written with another version is rebuilt
+SCHEMA_VERSION = 2
+# One row per (escalation, match). Phone numbers are not exported; the reporter's
+# email is, so support can reach everyone whose report was linked to a ticket.
+SCHEMA = pa.schema([
+    ("timestamp", pa.timestamp("s")),
+    ("log_offset", pa.int64()),            # byte offset of the escalation in logs.json (its id)
+    ("profit_center", pa.string()),
+    ("user_input", pa.string()),
+    ("extracted_phrase", pa.string()),
+    ("coalesced_into", pa.string()),
+    ("ticket", pa.string()),               # helpdesk issue number raised for, or linked to, this report
+    ("reporter", pa.string()),             # mail_id of the user who reported it
+    ("match_rank", pa.int8()),             # 1 = top match
+    ("kb_id", pa.int64()),
+    ("module", pa.string()),
+    ("issuename", pa.string()),
+    ("solutiontype", pa.string()),
+    ("score", pa.int16()),
+    ("score_band", pa.string()),
+    ("logcategory", pa.int64()),
+    ("logsubcategory", pa.int64()),
+])
+PARTITION_SCHEMA = pa.schema([("month", pa.string()), ("company", pa.string())])
+
+
+def score_band(score):
+    for floor, band in SCORE_BANDS:
+        if (score or 0) >= floor:
+            return band
+    return "no match"
+
+
+def _int_or_none(value):
+    try:
+        return int(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_timestamp(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+
+
+def _str_or_none(value):
+    return None if value in (None, "") else str(value)
+
+
+def iter_log_records(log_path=LOG_PATH, start=0):
+    """Stream (start_offset, end_offset, entry) from the logs.json array.
+
+    Entries are decoded one at a time from fixed-size chunks, so memory stays
+    flat however large the file grows. Offsets are in bytes; start must be 0 or
+    an end_offset returned earlier.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    with open(log_path, "rb") as f:
+        f.seek(start)
+        buf = ""
+        buf_offset = start  # byte offset of buf[0]
+        eof = False
+        while True:
+            # Skip the array punctuation between entries
+            pos = 0
+            while pos < len(buf) and buf[pos] in " \t\r\n[,":
+                pos += 1
+            if pos:
+                buf_offset += len(buf[:pos].encode("utf-8"))
+                buf = buf[pos:]
+            if buf.startswith("]") or (eof and not buf):
+                return
+            try:
+                entry, end = decoder.raw_decode(buf)
+            except json.JSONDecodeError:
+                if eof:
+                    print(f"Warning: {log_path} ends with an incomplete entry at byte {buf_offset}")
+                    return
+                chunk = f.read(READ_CHUNK_BYTES)
+                eof = not chunk
+                buf += text_decoder.decode(chunk, final=eof)
+                continue
+            end_offset = buf_offset + len(buf[:end].encode("utf-8"))
+            yield buf_offset, end_offset, entry
+            buf = buf[end:]
+            buf_offset = end_offset
+
+
+def flatten_entry(offset, entry):
+    """Turn one logs.json escalation into (partition, rows), one row per match."""
+    timestamp = entry.get("timestamp") or ""
+    month = timestamp[:7] if len(timestamp) >= 7 else "unknown"
+    company = _str_or_none(entry.get("company_code")) or "unknown"
+    base = {
+        "timestamp": _parse_timestamp(timestamp),
+        "log_offset": offset,
+        "profit_center": _str_or_none(entry.get("profit_center")),
+        "user_input": entry.get("user_input"),
+        "extracted_phrase": entry.get("extracted_phrase"),
+        "coalesced_into": _str_or_none(entry.get("coalesced_into")),
+        "ticket": _str_or_none(entry.get("coalesced_into") or entry.get("issue_number")),
+        "reporter": _str_or_none(entry.get("mail_id")),
+    }
+    rows = []
+    for rank, match in enumerate(entry.get("matches") or [{}], start=1):
+        score = _int_or_none(match.get("score")) or 0
+        rows.append(dict(
+            base,
+            match_rank=rank,
+            kb_id=_int_or_none(match.get("id")),
+            module=match.get("module"),
+            issuename=match.get("issuename"),
+            solutiontype=match.get("solutiontype"),
+            score=score,
+            score_band=score_band(score),
+            logcategory=_int_or_none(match.get("logcategory")),
+            logsubcategory=_int_or_none(match.get("logsubcategory")),
+        ))
+    return (month, company), rows
+
+
+def _partition_dir(out_dir, month, company):
+    return os.path.join(out_dir, f"month={month}", f"company={company}")
+
+
+def _write_part(out_dir, month, company, rows):
+    directory = _partition_dir(out_dir, month, company)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-{uuid.uuid4().hex}.parquet")
+    tmp_path = os.path.join(directory, f".{os.path.basename(path)}.tmp")
+    pq.write_table(pa.Table.from_pylist(rows, schema=SCHEMA), tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_watermark(out_dir=ANALYTICS_DIR):
+    try:
+        with open(os.path.join(out_dir, WATERMARK_FILE), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"offset": 0, "records": 0, "schema_version": SCHEMA_VERSION}
+
+
+def save_watermark(out_dir, watermark):
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(watermark, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+class _Misaligned(Exception):
+    """The watermark no longer points at an entry boundary of logs.json."""
+
+
+# Bytes before the watermark remembered to detect that logs.json was rewritten underneath it
+WATERMARK_TAIL_BYTES = 64
+
+
+def _read_tail(log_path, offset):
+    with open(log_path, "rb") as f:
+        f.seek(max(0, offset - WATERMARK_TAIL_BYTES))
+        return f.read(min(offset, WATERMARK_TAIL_BYTES)).decode("utf-8", errors="replace")
+
+
+def _at_entry_boundary(log_path, watermark):
+    """True if the watermark still sits right after an exported entry: `}` then `,` or `]`."""
+    offset = watermark["offset"]
+    if offset == 0:
+        return True
+    with open(log_path, "rb") as f:
+        f.seek(offset - 1)
+        if f.read(1) != b"}":
+            return False
+        if f.read(64).lstrip()[:1] not in (b",", b"]"):
+            return False
+    # Nested match objects end the same way, so also compare the bytes we last exported
+    return watermark.get("tail") in (None, _read_tail(log_path, offset))
+
+
+def _is_log_entry(entry):
+    return isinstance(entry, dict) and "user_input" in entry
+
+
+def export_logs(log_path=LOG_PATH, out_dir=ANALYTICS_DIR, batch_records=5000):
+    """Append escalations added to logs.json since the last run to the Parquet dataset.
+
+    logs.json only grows at the end and is replaced atomically on every write,
+    so the byte offset after the last exported entry is the watermark. If the
+    file shrank, the schema changed, or the watermark no longer lands on an
+    entry boundary (the log was rewritten by another writer), the dataset is
+    rebuilt from scratch. Returns the number of records exported.
+    """
+    if not os.path.exists(log_path):
+        print(f"Error: {log_path} not found")
+        return 0
+    os.makedirs(out_dir, exist_ok=True)
+    watermark = load_watermark(out_dir)
+    reset = None
+    if watermark.get("schema_version", 1) != SCHEMA_VERSION:
+        reset = "the export schema changed"
+    elif os.path.getsize(log_path) < watermark["offset"]:
+        reset = f"{log_path} shrank since the last export"
+    elif not _at_entry_boundary(log_path, watermark):
+        reset = f"the export watermark no longer falls on an entry boundary of {log_path}"
+    if not reset:
+        try:
+            return _export_from(log_path, out_dir, watermark, batch_records)
+        except _Misaligned as e:
+            reset = str(e)
+    print(f"Warning: {reset}, re-exporting everything")
+    _clear_dataset(out_dir)
+    return _export_from(log_path, out_dir, {"offset": 0, "records": 0}, batch_records)
+
+
+def _export_from(log_path, out_dir, watermark, batch_records):
+    resumed = watermark["offset"] > 0
+    pending = {}
+    pending_records = 0
+    exported = 0
+
+    def flush():
+        for (month, company), rows in pending.items():
+            _write_part(out_dir, month, company, rows)
+        pending.clear()
+        save_watermark(out_dir, dict(watermark, tail=_read_tail(log_path, watermark["offset"])))
+
+    for start, end, entry in iter_log_records(log_path, watermark["offset"]):
+        if not _is_log_entry(entry):
+            if resumed:
+                raise _Misaligned(f"found a non-entry value at byte {start} of {log_path}")
+            print(f"Warning: skipping non-entry value at byte {start} of {log_path}")
+            continue
+        partition, rows = flatten_entry(start, entry)
+        pending.setdefault(partition, []).extend(rows)
+        pending_records += 1
+        exported += 1
+        watermark = {"offset": end, "records": watermark["records"] + 1, "schema_version": SCHEMA_VERSION}
+        if pending_records >= batch_records:
+            flush()
+            pending_records = 0
+    if exported:
+        flush()
+    print(f"Exported {exported} escalations to {out_dir} ({watermark['records']} total)")
+    return exported
+
+
+def _clear_dataset(out_dir):
+    for root, _, files in os.walk(out_dir, topdown=False):
+        for name in files:
+            if name.endswith(".parquet") or name == WATERMARK_FILE:
+                os.remove(os.path.join(root, name))
+        if root != out_dir and not os.listdir(root):
+            os.rmdir(root)
+
+
+def compact_partitions(out_dir=ANALYTICS_DIR, min_files=COMPACT_MIN_FILES):
+    """Merge partitions with many small part files into one file sorted by time.
+
+    The merged file is written before the old parts are removed, so a crash
+    can duplicate a partition's rows but never lose them.
+    """
+    compacted = 0
+    for root, _, files in os.walk(out_dir):
+        parts = sorted(name for name in files if name.startswith("part-") and name.endswith(".parquet"))
+        if len(parts) < min_files:
+            continue
+        paths = [os.path.join(root, name) for name in parts]
+        table = pa.concat_tables(pq.read_table(path, schema=SCHEMA) for path in paths)
+        table = table.sort_by([("timestamp", "ascending"), ("log_offset", "ascending"), ("match_rank", "ascending")])
+        merged = os.path.join(root, f"part-{uuid.uuid4().hex}.parquet")
+        pq.write_table(table, merged + ".tmp", compression="zstd", row_group_size=128 * 1024)
+        os.replace(merged + ".tmp", merged)
+        for path in paths:
+            os.remove(path)
+        compacted += 1
+        print(f"Compacted {len(paths)} files in {os.path.relpath(root, out_dir)} ({table.num_rows} rows)")
+    return compacted
+
+
+if __name__ == "__main__":
+    # Scheduled job: python -m agents.log_export [logs.json] [output dir]
+    source = sys.argv[1] if len(sys.argv) > 1 else LOG_PATH
+    target = sys.argv[2] if len(sys.argv) > 2 else ANALYTICS_DIR
+    export_logs(source, target)
+    compact_partitions(target)
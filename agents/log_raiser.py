@@ -1,15 +1,27 @@
 import json
 import os
+import threading
 from datetime import datetime
 import requests
+from agents.escalation_coalescer import (
+    COALESCE_WAIT_SECONDS, coalesce_key, join_escalation, publish_ticket, wait_for_ticket
+)
 
 # File pathways
 LOG_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "logs.json")
 COMPANIES_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "company.json")
 
-# API endpoint
-API_ENDPOINT = "https://revion-aws-eu-uk-ldb2.revion.com/ords/a172083_test/helpdeskapi%20/issues"
+# API endpoint (HELPDESK_API_ENDPOINT overrides it, e.g. to point load tests at a local fake)
+API_ENDPOINT = os.getenv(
+    "HELPDESK_API_ENDPOINT",
+    "https://revion-aws-eu-uk-ldb2.revion.com/ords/a172083_test/helpdeskapi%20/issues"
+)
 API_HEADERS = {"Content-Type": "application/json"}
+# Kept below the coalescing wait so reporters queued behind a leader never give up first
+HELPDESK_TIMEOUT_SECONDS = min(float(os.getenv("HELPDESK_TIMEOUT_SECONDS", "20")), COALESCE_WAIT_SECONDS * 0.75)
+
+# Serializes the read-modify-write of logs.json across concurrent sessions
+_log_lock = threading.Lock()
 
 def load_companies():
     """Load company.json and return company data."""
@@ -46,6 +58,30 @@ def extract_logged_by(mail_id):
     local_part = mail_id.split('@')[0]
     return local_part.split('.')[0]
 
+def save_local_log(entry):
+    """Append an entry to logs.json."""
+    with _log_lock:
+        logs = []
+        if os.path.exists(LOG_PATH):
+            try:
+                with open(LOG_PATH, 'r') as f:
+                    logs = json.load(f)
+            except json.JSONDecodeError:
+                print("Warning: logs.json is corrupted, starting fresh.")
+                logs = []
+
+        logs.append(entry)
+
+        try:
+            # Write a temp file and rename it, so readers (e.g. the Parquet export) never see a half-written log
+            tmp_path = f"{LOG_PATH}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(logs, f, indent=4)
+            os.replace(tmp_path, LOG_PATH)
+            print(f"Log entry saved to {LOG_PATH} for input: {entry.get('user_input')}")
+        except Exception as e:
+            print(f"Error saving to {LOG_PATH}: {e}")
+
 def raise_log(params):
     """Generate a structured log entry and send to helpdesk API."""
     user_input = params.get("user_input")
@@ -104,76 +140,84 @@ def raise_log(params):
         ]
     }
 
-    # Save to logs.json
-    logs = []
-    if os.path.exists(LOG_PATH):
-        try:
-            with open(LOG_PATH, 'r') as f:
-                logs = json.load(f)
-        except json.JSONDecodeError:
-            print("Warning: logs.json is corrupted, starting fresh.")
-            logs = []
-    
-    logs.append(local_log_entry)
-    
-    try:
-        with open(LOG_PATH, 'w') as f:
-            json.dump(logs, f, indent=4)
-        print(f"Log entry saved to {LOG_PATH} for input: {user_input}")
-    except Exception as e:
-        print(f"Error saving to {LOG_PATH}: {e}")
-
-    # Prepare API payload
     top_match = matches[0] if matches and matches[0]["score"] > 0 else None
-    entity_code = extracted_phrase.split()[1] if extracted_phrase and len(extracted_phrase.split()) > 1 else user_input.split()[0] if user_input.split() else "unknown"
-    location_code = company_code or (extracted_phrase.split()[-1].rstrip(',') if extracted_phrase and len(extracted_phrase.split()) > 3 else "unknown")
-    
-    company_id = int(map_company_code(company_code)) if company_code else 490518
-    profit_center_id = int(map_profit_center(profit_center)) if profit_center else 3410
-    product_name = int(top_match["logcategory"]) if top_match and top_match.get("logcategory") else 3421
-    sub_category = int(top_match["logsubcategory"]) if top_match and top_match.get("logsubcategory") else 3425
-    
-    api_payload = {
-        "type": "Normal",
-        "company": company_id,
-        "location": 234,
-        "profit_center": profit_center_id,
-        "product_name": product_name,
-        "sub_category": sub_category,
-        "contact_no": contact_no or "08143556110",
-        "logged_by": extract_logged_by(mail_id) if mail_id else "unknown",
-        "mail_id": mail_id or "unknown@tolaram.com",
-        "cc_to": cc_to or "",
-        "impact": "Month End",
-        "subject": (top_match["issuename"].replace("XXXX", entity_code).replace("YYYY", location_code) if top_match 
-                    else extracted_phrase or user_input),
-        "description": f"User encountered an error in SAP system: {user_input}. {top_match['issuedescription'] if top_match else 'No matching error found.'}"
-    }
 
-    # Send HTTP POST request
+    # Coalesce duplicate escalations: later reporters of the same issue reuse the first ticket
+    coalesce_group_key = coalesce_key(user_input, top_match, company_code, profit_center)
+    group, is_leader = (None, True)
+    if coalesce_group_key:
+        group, is_leader = join_escalation(coalesce_group_key)
+    if not is_leader:
+        existing = wait_for_ticket(group)
+        if existing:
+            local_log_entry["coalesced_into"] = existing["issue_number"]
+            save_local_log(local_log_entry)
+            print(f"Escalation coalesced into ticket {existing['issue_number']} ({group['reporters']} reporters)")
+            return {
+                "status": "success",
+                "message": f"Escalation linked to existing ticket {existing['issue_number']}",
+                "response": dict(existing, coalesced=True)
+            }
+        print("Debug: first reporter's ticket failed, raising a new one")
+
+    # A leader must always publish (or drop) its group, even if building the ticket fails
     api_response = {"status_code": None, "response_text": "", "response_json": None, "issue_number": None, "zhi_id": None}
     try:
-        response = requests.post(API_ENDPOINT, json=api_payload, headers=API_HEADERS)
-        api_response = {
-            "status_code": response.status_code,
-            "response_text": response.text[:500],
-            "response_json": response.json() if response.headers.get('content-type', '').startswith('application/json') else None
+        # Prepare API payload
+        entity_code = extracted_phrase.split()[1] if extracted_phrase and len(extracted_phrase.split()) > 1 else user_input.split()[0] if user_input.split() else "unknown"
+        location_code = company_code or (extracted_phrase.split()[-1].rstrip(',') if extracted_phrase and len(extracted_phrase.split()) > 3 else "unknown")
+
+        company_id = int(map_company_code(company_code)) if company_code else 490518
+        profit_center_id = int(map_profit_center(profit_center)) if profit_center else 3410
+        product_name = int(top_match["logcategory"]) if top_match and top_match.get("logcategory") else 3421
+        sub_category = int(top_match["logsubcategory"]) if top_match and top_match.get("logsubcategory") else 3425
+
+        api_payload = {
+            "type": "Normal",
+            "company": company_id,
+            "location": 234,
+            "profit_center": profit_center_id,
+            "product_name": product_name,
+            "sub_category": sub_category,
+            "contact_no": contact_no or "08143556110",
+            "logged_by": extract_logged_by(mail_id) if mail_id else "unknown",
+            "mail_id": mail_id or "unknown@tolaram.com",
+            "cc_to": cc_to or "",
+            "impact": "Month End",
+            "subject": (top_match["issuename"].replace("XXXX", entity_code).replace("YYYY", location_code) if top_match 
+                        else extracted_phrase or user_input),
+            "description": f"User encountered an error in SAP system: {user_input}. {top_match['issuedescription'] if top_match else 'No matching error found.'}"
         }
-        if response.status_code in (200, 201):
-            print(f"Log entry sent to API: {response.status_code}")
-            if api_response["response_json"] and "response" in api_response["response_json"]:
-                try:
-                    nested_response = json.loads(api_response["response_json"]["response"])
-                    api_response["issue_number"] = nested_response.get("issue_number")
-                    api_response["zhi_id"] = nested_response.get("zhi_id")
-                    print(f"Ticket created: Issue Number = {api_response['issue_number']}, zhi_id = {api_response['zhi_id']}")
-                except json.JSONDecodeError:
-                    print("Warning: Failed to parse nested JSON response")
-        else:
-            print(f"Failed to send log to API: {response.status_code} - {response.text[:500]}")
-    except requests.RequestException as e:
-        print(f"Error sending POST request: {e}")
-        api_response = {"status_code": None, "response_text": str(e), "response_json": None, "issue_number": None, "zhi_id": None}
+
+        # Send HTTP POST request
+        try:
+            response = requests.post(API_ENDPOINT, json=api_payload, headers=API_HEADERS, timeout=HELPDESK_TIMEOUT_SECONDS)
+            api_response = {
+                "status_code": response.status_code,
+                "response_text": response.text[:500],
+                "response_json": response.json() if response.headers.get('content-type', '').startswith('application/json') else None
+            }
+            if response.status_code in (200, 201):
+                print(f"Log entry sent to API: {response.status_code}")
+                if api_response["response_json"] and "response" in api_response["response_json"]:
+                    try:
+                        nested_response = json.loads(api_response["response_json"]["response"])
+                        api_response["issue_number"] = nested_response.get("issue_number")
+                        api_response["zhi_id"] = nested_response.get("zhi_id")
+                        print(f"Ticket created: Issue Number = {api_response['issue_number']}, zhi_id = {api_response['zhi_id']}")
+                    except json.JSONDecodeError:
+                        print("Warning: Failed to parse nested JSON response")
+            else:
+                print(f"Failed to send log to API: {response.status_code} - {response.text[:500]}")
+        except requests.RequestException as e:
+            print(f"Error sending POST request: {e}")
+            api_response = {"status_code": None, "response_text": str(e), "response_json": None, "issue_number": None, "zhi_id": None}
+    finally:
+        # Saved with its ticket number, so linked reports (coalesced_into) can be traced back to it
+        local_log_entry["issue_number"] = api_response.get("issue_number")
+        save_local_log(local_log_entry)
+        if group is not None and is_leader:
+            publish_ticket(coalesce_group_key, group, api_response)
 
     print(f"API response: {api_response}")
     return {
@@ -0,0 +1,115 @@
+import sys
+import time
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from agents.log_export import ANALYTICS_DIR, PARTITION_SCHEMA
+
+
+def open_dataset(out_dir=ANALYTICS_DIR):
+    """The exported escalations as a hive-partitioned (month, company) Parquet dataset."""
+    return ds.dataset(out_dir, format="parquet", partitioning=ds.partitioning(PARTITION_SCHEMA, flavor="hive"))
+
+
+def _filter(start_month=None, end_month=None, company=None, top_only=True):
+    """Filter expression; month/company only touch the partition directories."""
+    conditions = []
+    if top_only:
+        conditions.append(ds.field("match_rank") == 1)
+    if start_month:
+        conditions.append(ds.field("month") >= start_month)
+    if end_month:
+        conditions.append(ds.field("month") <= end_month)
+    if company:
+        conditions.append(ds.field("company") == str(company))
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def _read(dataset, columns, **filters):
+    # Only the listed columns are read from disk
+    return dataset.to_table(columns=columns, filter=_filter(**filters))
+
+
+def coverage_report(dataset=None, start_month=None, end_month=None, company=None):
+    """Escalations per company/profit center and top-match score band.
+
+    Columns: company, profit_center, score_band, escalations, share
+    (share of that company/profit center's escalations). "no match" rows are
+    escalations the KB had no entry for.
+    """
+    dataset = dataset or open_dataset()
+    table = _read(dataset, ["company", "profit_center", "score_band"],
+                  start_month=start_month, end_month=end_month, company=company)
+    keys = ["company", "profit_center", "score_band"]
+    counts = table.group_by(keys).aggregate([([], "count_all")]).rename_columns(keys + ["escalations"])
+    df = counts.to_pandas()
+    if df.empty:
+        df["share"] = []
+        return df
+    totals = df.groupby(["company", "profit_center"], dropna=False)["escalations"].transform("sum")
+    df["share"] = (df["escalations"] / totals).round(3)
+    return df.sort_values(["company", "profit_center", "escalations"], ascending=[True, True, False],
+                          ignore_index=True)
+
+
+def escalation_rate_report(dataset=None, start_month=None, end_month=None, company=None, top_n=20):
+    """KB entries that drive the most escalations (by top match).
+
+    Columns: kb_id, issuename, escalations, tickets (escalations not coalesced
+    into an existing ticket), companies, profit_centers, avg_score and rate
+    (share of all escalations in the period).
+    """
+    dataset = dataset or open_dataset()
+    table = _read(dataset, ["kb_id", "issuename", "company", "profit_center", "score", "coalesced_into"],
+                  start_month=start_month, end_month=end_month, company=company)
+    total = table.num_rows
+    table = table.filter(pc.is_valid(table["kb_id"]))
+    table = table.append_column("new_ticket", pc.cast(pc.is_null(table["coalesced_into"]), "int64"))
+    grouped = table.group_by(["kb_id", "issuename"]).aggregate([
+        ([], "count_all"),
+        ("new_ticket", "sum"),
+        ("company", "count_distinct"),
+        ("profit_center", "count_distinct"),
+        ("score", "mean"),
+    ]).rename_columns(["kb_id", "issuename", "escalations", "tickets", "companies", "profit_centers", "avg_score"])
+    df = grouped.to_pandas()
+    df["avg_score"] = df["avg_score"].round(1)
+    df["rate"] = (df["escalations"] / total).round(3) if total else 0.0
+    return df.sort_values(["escalations", "kb_id"], ascending=[False, True], ignore_index=True).head(top_n)
+
+
+def ticket_reporters_report(dataset=None, start_month=None, end_month=None, company=None):
+    """Helpdesk tickets that several users' escalations were linked to (coalesced).
+
+    Columns: ticket, issuename, reports, reporters (distinct mail_ids),
+    first_reported and last_reported; only tickets with more than one report.
+    """
+    dataset = dataset or open_dataset()
+    table = _read(dataset, ["ticket", "issuename", "reporter", "timestamp"],
+                  start_month=start_month, end_month=end_month, company=company)
+    table = table.filter(pc.is_valid(table["ticket"]))
+    grouped = table.group_by(["ticket"]).aggregate([
+        ("issuename", "min"),
+        ([], "count_all"),
+        ("reporter", "distinct"),
+        ("timestamp", "min"),
+        ("timestamp", "max"),
+    ]).rename_columns(["ticket", "issuename", "reports", "reporters", "first_reported", "last_reported"])
+    df = grouped.to_pandas()
+    df = df[df["reports"] > 1]
+    return df.sort_values(["reports", "ticket"], ascending=[False, True], ignore_index=True)
+
+
+if __name__ == "__main__":
+    # python -m agents.log_reports [start_month] [end_month] [company], months as YYYY-MM
+    args = sys.argv[1:] + [None] * 3
+    filters = {"start_month": args[0], "end_month": args[1], "company": args[2]}
+    dataset = open_dataset()
+    for title, report in (("Coverage", coverage_report), ("Escalation rate by KB entry", escalation_rate_report),
+                          ("Tickets with linked reports", ticket_reporters_report)):
+        started = time.perf_counter()
+        df = report(dataset, **filters)
+        print(f"\n{title} ({(time.perf_counter() - started) * 1000:.0f} ms)")
+        print(df.to_string(index=False))
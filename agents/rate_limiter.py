@@ -0,0 +1,266 @@
+import asyncio
+import heapq
+import itertools
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+# Provider limits for this API key; 0 disables that bucket
+REQUESTS_PER_MINUTE = float(os.getenv("ANTHROPIC_REQUESTS_PER_MINUTE", "50"))
+TOKENS_PER_MINUTE = float(os.getenv("ANTHROPIC_TOKENS_PER_MINUTE", "50000"))
+# Set to share the buckets between worker processes on this host (e.g. data/ratelimit.db)
+RATE_LIMIT_DB = os.getenv("ANTHROPIC_RATE_LIMIT_DB", "")
+
+# Lower number = served first; within a priority requests are FIFO
+INTERACTIVE = 0   # the main completion of a chat turn
+SUGGESTION = 1    # fallback suggestion completions
+BACKGROUND = 2    # breaker recovery probes
+
+CHARS_PER_TOKEN = 4
+
+
+class RateLimitTimeout(Exception):
+    """No request/token budget became available before the caller's deadline."""
+
+
+def estimate_tokens(kwargs):
+    """Rough token cost of a messages.create call: prompt size plus max_tokens."""
+    prompt = json.dumps([kwargs.get("system"), kwargs.get("messages"), kwargs.get("tools")], default=str)
+    return len(prompt) // CHARS_PER_TOKEN + int(kwargs.get("max_tokens") or 0)
+
+
+class MemoryBuckets:
+    """Token buckets shared by every session in this process."""
+
+    def __init__(self, limits):
+        # name -> (capacity, refill per second); buckets start full
+        self.limits = limits
+        self._lock = threading.RLock()  # re-entered by SQLiteBuckets._update
+        now = time.time()
+        self.levels = {name: [capacity, now] for name, (capacity, _) in limits.items()}
+
+    def _refill(self, name, now):
+        capacity, rate = self.limits[name]
+        level, updated = self.levels[name]
+        return min(capacity, level + (now - updated) * rate)
+
+    def take(self, costs):
+        """Take all costs at once; returns 0 on success, else seconds until they would fit."""
+        with self._lock:
+            now = time.time()
+            levels = {name: self._refill(name, now) for name in costs}
+            wait = max((costs[name] - levels[name]) / self.limits[name][1] for name in costs)
+            if wait <= 0:
+                for name, cost in costs.items():
+                    self.levels[name] = [levels[name] - cost, now]
+                return 0.0
+            for name, level in levels.items():
+                self.levels[name] = [level, now]
+            return wait
+
+    def adjust(self, name, delta):
+        """Correct a bucket by delta (negative = debit); it may go below zero."""
+        with self._lock:
+            now = time.time()
+            self.levels[name] = [self._refill(name, now) + delta, now]
+
+    def drain(self, name, seconds):
+        """Empty a bucket so nothing is granted for roughly the next seconds."""
+        with self._lock:
+            self.levels[name] = [-seconds * self.limits[name][1], time.time()]
+
+
+class SQLiteBuckets(MemoryBuckets):
+    """Token buckets stored in a local SQLite file, shared by worker processes.
+
+    Every update runs in a BEGIN IMMEDIATE transaction, so the file lock
+    serializes workers; refills use wall-clock time for the same reason.
+    """
+
+    def __init__(self, limits, path):
+        super().__init__(limits)
+        self.path = path
+        conn = self._connect()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS rate_buckets (name TEXT PRIMARY KEY, level REAL, updated REAL)")
+            conn.executemany(
+                "INSERT OR IGNORE INTO rate_buckets (name, level, updated) VALUES (?, ?, ?)",
+                [(name, capacity, time.time()) for name, (capacity, _) in limits.items()]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def _update(self, func):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute("SELECT name, level, updated FROM rate_buckets").fetchall()
+            with self._lock:
+                self.levels.update({name: [level, updated] for name, level, updated in rows if name in self.limits})
+                result = func()
+                levels = [(level, updated, name) for name, (level, updated) in self.levels.items()]
+            conn.executemany("UPDATE rate_buckets SET level = ?, updated = ? WHERE name = ?", levels)
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+
+    def take(self, costs):
+        return self._update(lambda: MemoryBuckets.take(self, costs))
+
+    def adjust(self, name, delta):
+        self._update(lambda: MemoryBuckets.adjust(self, name, delta))
+
+    def drain(self, name, seconds):
+        self._update(lambda: MemoryBuckets.drain(self, name, seconds))
+
+
+class RateLimiter:
+    """Priority queue in front of the request and token buckets.
+
+    Only the head of the queue (best priority, then oldest) may take from the
+    buckets, so a burst of suggestion calls can never delay a main turn that
+    arrives after them. Waiters give up with RateLimitTimeout at their deadline.
+    Must be used from a single event loop (chat_core's).
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._queue = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.recent_waits = deque(maxlen=500)
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {"granted": 0, "queued": 0, "timeouts": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0,
+                          "max_queue_depth": 0, "throttled_by_provider": 0}
+            self.recent_waits.clear()
+
+    async def _buckets_call(self, method, *args):
+        """Run a bucket operation; SQLite ones block on the file lock, so they go to an executor."""
+        if isinstance(self.buckets, SQLiteBuckets):
+            return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+        return method(*args)
+
+    def _costs(self, tokens):
+        costs = {}
+        for name, cost in (("requests", 1), ("tokens", tokens)):
+            if name in self.buckets.limits:
+                # A single call larger than the bucket would never fit; let it through on a full bucket
+                costs[name] = min(cost, self.buckets.limits[name][0])
+        return costs
+
+    def _wake_head(self):
+        if self._queue:
+            self._queue[0][3].set()
+
+    async def acquire(self, tokens, priority, deadline):
+        """Wait for one request slot and tokens; returns seconds spent queued."""
+        costs = self._costs(tokens)
+        if not costs:
+            return 0.0
+        started = time.monotonic()
+        entry = (priority, next(self._seq), costs, asyncio.Event())
+        heapq.heappush(self._queue, entry)
+        with self._lock:
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self._queue))
+        queued = False
+        try:
+            while True:
+                # Cleared before checking, so a wake-up during the check below is not lost
+                entry[3].clear()
+                wait = None
+                if self._queue[0] is entry:
+                    wait = await self._buckets_call(self.buckets.take, costs)
+                    if wait <= 0:
+                        waited = time.monotonic() - started
+                        self._record_wait(waited)
+                        return waited
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._count(timeouts=1)
+                    raise RateLimitTimeout(f"rate limit queue wait exceeded the deadline (priority {priority})")
+                if not queued:
+                    queued = True
+                    self._count(queued=1)  # calls that could not be granted straight away
+                try:
+                    await asyncio.wait_for(entry[3].wait(), min(wait, remaining) if wait else remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+            self._wake_head()
+
+    async def settle(self, estimated_tokens, actual_tokens):
+        """Charge the difference between a call's estimated and reported token usage."""
+        if "tokens" in self.buckets.limits and actual_tokens is not None:
+            await self._buckets_call(self.buckets.adjust, "tokens", estimated_tokens - actual_tokens)
+
+    async def pause(self, seconds):
+        """The provider returned 429: hold every queued request for about `seconds`."""
+        self._count(throttled_by_provider=1)
+        if "requests" in self.buckets.limits:
+            await self._buckets_call(self.buckets.drain, "requests", seconds)
+        self._wake_head()
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                self.stats[name] += delta
+
+    def _record_wait(self, waited):
+        with self._lock:
+            self.stats["granted"] += 1
+            self.stats["wait_seconds"] += waited
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+            self.recent_waits.append(waited)
+
+    def snapshot(self):
+        """Queue depth (total and per priority) and wait-time metrics."""
+        with self._lock:
+            stats = dict(self.stats)
+            waits = sorted(self.recent_waits)
+        depth = {}
+        for priority, *_ in list(self._queue):
+            depth[priority] = depth.get(priority, 0) + 1
+        stats["queue_depth"] = sum(depth.values())
+        stats["queue_depth_by_priority"] = depth
+        stats["avg_wait_ms"] = stats["wait_seconds"] / stats["granted"] * 1000 if stats["granted"] else 0.0
+        stats["p95_wait_ms"] = waits[max(0, math.ceil(0.95 * len(waits)) - 1)] * 1000 if waits else 0.0
+        stats["recent_waits"] = waits
+        return stats
+
+
+def _build_limiter():
+    limits = {}
+    if REQUESTS_PER_MINUTE > 0:
+        limits["requests"] = (REQUESTS_PER_MINUTE, REQUESTS_PER_MINUTE / 60)
+    if TOKENS_PER_MINUTE > 0:
+        limits["tokens"] = (TOKENS_PER_MINUTE, TOKENS_PER_MINUTE / 60)
+    if RATE_LIMIT_DB and limits:
+        return RateLimiter(SQLiteBuckets(limits, RATE_LIMIT_DB))
+    return RateLimiter(MemoryBuckets(limits))
+
+
+# Shared by every session in the process (and across workers when RATE_LIMIT_DB is set)
+RATE_LIMITER = _build_limiter()
+
+
+def rate_limiter_stats():
+    """Queue depth and wait-time metrics of the process-wide limiter."""
+    return RATE_LIMITER.snapshot()
+
+
+def reset_rate_limiter_stats():
+    RATE_LIMITER.reset_stats()
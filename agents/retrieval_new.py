@@ -3,16 +3,31 @@ import re
 from fuzzywuzzy import fuzz
 import os
 import json
+import threading
+from collections import OrderedDict
+from agents.kb_snapshot import FILTER_KEYWORDS, SNAPSHOT_PATH, build_snapshot, normalize_issuename, open_snapshot
 
 # Database path
 DB_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "errors.db")
 
-# Cache for normalized issuename values
+# Cache for normalized issuename values (only used when no KB snapshot is available)
 ERROR_CACHE = None
+_ERROR_CACHE_BY_ID = {}
+
+# Number of matches returned; only these get their full rows fetched
+TOP_K = 3
+# Small LRU of full KB rows (id -> row tuple) for the final top-k fetch
+KB_ROW_CACHE_SIZE = int(os.getenv("KB_ROW_CACHE_SIZE", "128"))
+KB_ROW_CACHE = OrderedDict()
+_row_cache_lock = threading.Lock()
+
+# Memory-mapped KB snapshot, opened at import so a fresh worker needs no cold load
+KB_SNAPSHOT = open_snapshot(SNAPSHOT_PATH, DB_PATH)
+_snapshot_lock = threading.Lock()
 
 def load_error_cache():
     """Load and cache normalized issuename values from database."""
-    global ERROR_CACHE
+    global ERROR_CACHE, _ERROR_CACHE_BY_ID
     if ERROR_CACHE is None:
         try:
             conn = sqlite3.connect(DB_PATH)
@@ -20,15 +35,42 @@ def load_error_cache():
             cursor.execute("SELECT id, issuename FROM errors")
             errors = cursor.fetchall()
             ERROR_CACHE = [
-                {"id": error_id, "normalized_issuename": issuename.lower().replace('xxxx', '').replace('yyyy', '')}
+                {"id": error_id, "normalized_issuename": normalize_issuename(issuename)}
                 for error_id, issuename in errors
             ]
+            _ERROR_CACHE_BY_ID = {e["id"]: e["normalized_issuename"] for e in ERROR_CACHE}
             conn.close()
             print(f"Cached {len(ERROR_CACHE)} error issuenames")
         except sqlite3.OperationalError as e:
             print(f"Cannot load cache: {e}")
             ERROR_CACHE = []
 
+def ensure_kb_snapshot():
+    """Build the KB snapshot if it is missing or errors.db changed, then map it."""
+    global KB_SNAPSHOT
+    if KB_SNAPSHOT is not None and KB_SNAPSHOT.is_fresh(DB_PATH):
+        return KB_SNAPSHOT
+    with _snapshot_lock:
+        if KB_SNAPSHOT is not None and KB_SNAPSHOT.is_fresh(DB_PATH):
+            return KB_SNAPSHOT
+        snapshot = open_snapshot(SNAPSHOT_PATH, DB_PATH)  # another worker may have built it
+        if snapshot is None:
+            try:
+                build_snapshot(DB_PATH, SNAPSHOT_PATH)
+                snapshot = open_snapshot(SNAPSHOT_PATH, DB_PATH)
+            except (sqlite3.Error, OSError) as e:
+                print(f"Cannot build KB snapshot: {e}")
+        KB_SNAPSHOT = snapshot
+        with _row_cache_lock:
+            KB_ROW_CACHE.clear()  # errors.db changed, cached rows may be stale
+    return KB_SNAPSHOT
+
+def get_normalized_issuename(error_id):
+    """Normalized issuename for error_id from the snapshot (or the fallback cache)."""
+    if KB_SNAPSHOT is not None:
+        return KB_SNAPSHOT.normalized_issuename(error_id)
+    return _ERROR_CACHE_BY_ID.get(error_id)
+
 def extract_error_phrase(user_input):
     """Extract the most relevant error-related phrase from user input."""
     print(f"Extracting phrase from: {user_input}")
@@ -56,10 +98,81 @@ def extract_error_phrase(user_input):
     print(f"Extracted phrase: {best_phrase}")
     return best_phrase
 
+def _candidate_rows(conn, input_keywords, company_code, profit_center):
+    """Phase 1: (id, normalized issuename) for every row the filters let through.
+
+    Uses the snapshot's keyword postings when there is no company/profit
+    center filter; otherwise selects ids only and looks names up locally.
+    """
+    if KB_SNAPSHOT is not None and not (company_code or profit_center):
+        if input_keywords:
+            positions = sorted(set().union(*(KB_SNAPSHOT.keyword_rows(keyword) for keyword in input_keywords)))
+        else:
+            positions = range(len(KB_SNAPSHOT))
+        return [(KB_SNAPSHOT.ids[pos], KB_SNAPSHOT.name(pos)) for pos in positions]
+
+    query = "SELECT id FROM errors"
+    params = []
+
+    if input_keywords:
+        keyword_conditions = " OR ".join([f"issuename LIKE ?" for _ in input_keywords])
+        query += f" WHERE {keyword_conditions}"
+        params.extend([f"%{keyword}%" for keyword in input_keywords])
+
+    if company_code or profit_center:
+        if input_keywords:
+            query += " AND "
+        else:
+            query += " WHERE "
+        query += """
+        id IN (
+            SELECT e.id
+            FROM errors e
+            LEFT JOIN mappings m ON e.logcategory = m.logcategory OR e.logsubcategory = m.logsubcategory
+            WHERE (m.type = 'company' AND m.code = ?) OR (m.type = 'profit_center' AND m.code = ?)
+        )
+        """
+        params.extend([company_code or '', profit_center or ''])
+
+    candidates = []
+    for (error_id,) in conn.execute(query, params).fetchall():
+        match_text = get_normalized_issuename(error_id)
+        if match_text is not None:
+            candidates.append((error_id, match_text))
+    return candidates
+
+def fetch_error_details(conn, error_ids):
+    """Phase 2: full KB rows for error_ids, served from a small LRU with one keyed query for misses."""
+    rows = {}
+    missing = []
+    with _row_cache_lock:
+        for error_id in error_ids:
+            if error_id in KB_ROW_CACHE:
+                KB_ROW_CACHE.move_to_end(error_id)
+                rows[error_id] = KB_ROW_CACHE[error_id]
+            else:
+                missing.append(error_id)
+    if missing:
+        placeholders = ", ".join("?" for _ in missing)
+        fetched = conn.execute(
+            "SELECT id, module, issuename, issuedescription, solutiontype, stepbystep, logcategory, logsubcategory, notes "
+            f"FROM errors WHERE id IN ({placeholders})",
+            missing
+        ).fetchall()
+        with _row_cache_lock:
+            for row in fetched:
+                rows[row[0]] = row[1:]
+                KB_ROW_CACHE[row[0]] = row[1:]
+                KB_ROW_CACHE.move_to_end(row[0])
+            while len(KB_ROW_CACHE) > KB_ROW_CACHE_SIZE:
+                KB_ROW_CACHE.popitem(last=False)
+    return rows
+
 def retrieve_errors(user_input, company_code=None, profit_center=None, threshold=65):
     """Retrieve matching errors from the database based on user_input."""
     print(f"Retrieving errors for input: {user_input}, company_code: {company_code}, profit_center: {profit_center}")
-    load_error_cache()
+    if KB_SNAPSHOT is None:
+        load_error_cache()
     
     try:
         conn = sqlite3.connect(DB_PATH)
@@ -77,36 +190,26 @@ def retrieve_errors(user_input, company_code=None, profit_center=None, threshold
             "notes": None,
             "score": 0
         }]
-    cursor = conn.cursor()
 
-    input_keywords = set(user_input.lower().split()) & set(['material', 'plant', 'vendor', 'company', 'code', 'bank', 'details', 'missing', 'not', 'in'])
-    
-    query = "SELECT id, module, issuename, issuedescription, solutiontype, stepbystep, logcategory, logsubcategory, notes FROM errors"
-    params = []
-    
-    if input_keywords:
-        keyword_conditions = " OR ".join([f"issuename LIKE ?" for _ in input_keywords])
-        query += f" WHERE {keyword_conditions}"
-        params.extend([f"%{keyword}%" for keyword in input_keywords])
-    
-    if company_code or profit_center:
-        if input_keywords:
-            query += " AND "
-        else:
-            query += " WHERE "
-        query += """
-        id IN (
-            SELECT e.id
-            FROM errors e
-            LEFT JOIN mappings m ON e.logcategory = m.logcategory OR e.logsubcategory = m.logsubcategory
-            WHERE (m.type = 'company' AND m.code = ?) OR (m.type = 'profit_center' AND m.code = ?)
-        )
-        """
-        params.extend([company_code or '', profit_center or ''])
+    input_keywords = set(user_input.lower().split()) & set(FILTER_KEYWORDS)
 
+    # Score on ids + normalized names only; heavy text columns are fetched for the winners below
     try:
-        cursor.execute(query, params)
-        errors = cursor.fetchall()
+        candidates = _candidate_rows(conn, input_keywords, company_code, profit_center)
+        scored = []
+        error_phrase_normalized = normalize_issuename(user_input)
+        for error_id, match_text in candidates:
+            score = max(
+                fuzz.partial_ratio(error_phrase_normalized, match_text),
+                fuzz.token_sort_ratio(error_phrase_normalized, match_text),
+                fuzz.token_set_ratio(error_phrase_normalized, match_text)
+            )
+            if score >= threshold:
+                scored.append((error_id, score))
+        # Sort matches by score in descending order and take top 3
+        scored.sort(key=lambda x: x[1], reverse=True)
+        scored = scored[:TOP_K]
+        details = fetch_error_details(conn, [error_id for error_id, _ in scored])
     except sqlite3.OperationalError as e:
         print(f"Error executing query: {e}")
         conn.close()
@@ -124,31 +227,22 @@ def retrieve_errors(user_input, company_code=None, profit_center=None, threshold
         }]
 
     matches = []
-    error_phrase_normalized = user_input.lower().replace('xxxx', '').replace('yyyy', '')
-    for error in errors:
-        error_id, module, issuename, issuedescription, solutiontype, stepbystep, logcategory, logsubcategory, notes = error
-        cached_entry = next((e for e in ERROR_CACHE if e["id"] == error_id), None)
-        if not cached_entry:
-            continue
-        match_text = cached_entry["normalized_issuename"]
-        score = max(
-            fuzz.partial_ratio(error_phrase_normalized, match_text),
-            fuzz.token_sort_ratio(error_phrase_normalized, match_text),
-            fuzz.token_set_ratio(error_phrase_normalized, match_text)
-        )
-        if score >= threshold:
-            matches.append({
-                "id": error_id,
-                "module": module or "Unknown",  # CHANGED: Added default to avoid None
-                "issuename": issuename or "Unknown Issue",  # CHANGED: Added default
-                "issuedescription": issuedescription or user_input,  # CHANGED: Added default
-                "solution": stepbystep or "No solution provided",  # CHANGED: Added default
-                "solutiontype": solutiontype or "consult",  # CHANGED: Added default
-                "logcategory": logcategory,
-                "logsubcategory": logsubcategory,
-                "notes": notes,
-                "score": score
-            })
+    for error_id, score in scored:
+        if error_id not in details:
+            continue  # deleted since the snapshot/cache was built
+        module, issuename, issuedescription, solutiontype, stepbystep, logcategory, logsubcategory, notes = details[error_id]
+        matches.append({
+            "id": error_id,
+            "module": module or "Unknown",  # CHANGED: Added default to avoid None
+            "issuename": issuename or "Unknown Issue",  # CHANGED: Added default
+            "issuedescription": issuedescription or user_input,  # CHANGED: Added default
+            "solution": stepbystep or "No solution provided",  # CHANGED: Added default
+            "solutiontype": solutiontype or "consult",  # CHANGED: Added default
+            "logcategory": logcategory,
+            "logsubcategory": logsubcategory,
+            "notes": notes,
+            "score": score
+        })
 
     if not matches:
         print("Debug: No matches found, returning default response")  # CHANGED: Added debug log
@@ -165,10 +259,7 @@ def retrieve_errors(user_input, company_code=None, profit_center=None, threshold
             "score": 0
         }]
 
-    # Sort matches by score in descending order and take top 3
-    matches.sort(key=lambda x: x["score"], reverse=True)
-    top_matches = matches[:3]
-    for match in top_matches:
+    for match in matches:
         print(f"Match (Score: {match['score']}):")
         print(f"Module: {match.get('module', 'Unknown')}")  # CHANGED: Safe key access
         print(f"Issue: {match.get('issuename', 'Unknown Issue')}")  # CHANGED: Safe key access
@@ -177,7 +268,7 @@ def retrieve_errors(user_input, company_code=None, profit_center=None, threshold
         print(f"Solutiontype: {match.get('solutiontype', 'consult')}")  # CHANGED: Safe key access (fixes KeyError)
         print(f"Notes: {match.get('notes', 'None')}")  # CHANGED: Safe key access
     conn.close()  # CHANGED: Ensure connection is closed
-    return top_matches
+    return matches
 
 if __name__ == "__main__":
     # Simple test function for standalone execution
@@ -0,0 +1,131 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from agents.retrieval_new import retrieve_errors, extract_error_phrase
+
+# SPECULATIVE_RETRIEVAL=0 turns speculation off
+SPECULATION_ENABLED = os.getenv("SPECULATIVE_RETRIEVAL", "1") != "0"
+
+# Only speculate when the model is likely to call retrieve_errors (explicit error wording)
+SPECULATE_PATTERN = re.compile(r"error|issue|problem|blocked|not found|missing|failed|does not exist|not in|is not", re.IGNORECASE)
+
+_stats_lock = threading.Lock()
+SPECULATION_STATS = {
+    "started": 0,     # turns that speculated
+    "hits": 0,        # tool calls served from a speculative result
+    "misses": 0,      # tool calls whose arguments did not match (result discarded)
+    "unused": 0,      # speculated turns where the model never called retrieve_errors
+    "saved_seconds": 0.0
+}
+
+
+def _count(**deltas):
+    with _stats_lock:
+        for name, delta in deltas.items():
+            SPECULATION_STATS[name] += delta
+
+
+def speculation_stats():
+    """Snapshot of the speculation counters with hit rate and average latency saved."""
+    with _stats_lock:
+        stats = dict(SPECULATION_STATS)
+    calls = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / calls if calls else 0.0
+    stats["avg_saved_ms"] = stats["saved_seconds"] / stats["hits"] * 1000 if stats["hits"] else 0.0
+    return stats
+
+
+def reset_speculation_stats():
+    with _stats_lock:
+        for name in SPECULATION_STATS:
+            SPECULATION_STATS[name] = 0.0 if name == "saved_seconds" else 0
+
+
+def speculation_key(user_input, company_code=None, profit_center=None, **extra):
+    """Key under which retrieve_errors arguments count as "the same call".
+
+    Retrieval lowercases its input before matching, so case and whitespace are ignored.
+    """
+    if extra:
+        return None  # e.g. a custom threshold – never speculated
+    return (" ".join(str(user_input or "").split()).lower(), company_code or None, profit_center or None)
+
+
+def _original_case(prompt, phrase):
+    """Map extract_error_phrase's lowercased output back onto the prompt's casing."""
+    lowered = prompt.lower()
+    start = lowered.find(phrase)
+    if start < 0 or len(lowered) != len(prompt):
+        return phrase
+    return prompt[start:start + len(phrase)]
+
+
+def _timed_retrieve(user_input):
+    return retrieve_errors(user_input), time.monotonic()
+
+
+class Speculation:
+    """Speculative retrieve_errors calls started while the first completion is in flight.
+
+    Candidates are the whole prompt and its extracted error phrase, the two
+    arguments the model most often passes to the tool.
+    """
+
+    def __init__(self, prompt, submit):
+        self.started = time.monotonic()
+        self.used = False
+        self.futures = {}
+        for candidate in (prompt, _original_case(prompt, extract_error_phrase(prompt))):
+            key = speculation_key(candidate)
+            if key[0] and key not in self.futures:
+                self.futures[key] = submit(_timed_retrieve, candidate)
+        _count(started=1)
+
+    async def take(self, tool_input, count=True):
+        """Return the precomputed result for tool_input, or None if it must run for real.
+
+        count=False reuses the result without touching the hit/miss stats, for
+        lookups the model did not ask for (e.g. KB-only answers).
+        """
+        self.used = True
+        requested_at = time.monotonic()
+        future = self.futures.get(speculation_key(**tool_input))
+        if future is None:
+            if count:
+                _count(misses=1)
+            return None
+        try:
+            # shield: the same lookup may serve several tool calls, one of which can be cancelled
+            result, finished = await asyncio.shield(future)
+        except Exception as e:
+            print(f"Debug: speculative retrieval failed: {e}")
+            if count:
+                _count(misses=1)
+            return None
+        if not count:
+            return result
+        saved = min(finished, requested_at) - self.started
+        _count(hits=1, saved_seconds=saved)
+        print(f"Debug: speculative retrieval hit, saved {saved * 1000:.0f} ms")
+        return result
+
+    def close(self):
+        """Discard whatever was not used once the turn is over."""
+        if not self.used:
+            _count(unused=1)
+        for future in self.futures.values():
+            if future.done() and not future.cancelled():
+                future.exception()  # mark as retrieved so asyncio does not warn
+            future.cancel()
+
+
+def start_speculation(prompt, submit):
+    """Start speculating on prompt if it looks like an explicit error; else None.
+
+    submit(func, *args) must schedule func on a worker and return an awaitable future.
+    """
+    if not SPECULATION_ENABLED or not prompt or not SPECULATE_PATTERN.search(prompt):
+        return None
+    return Speculation(prompt, submit)
@@ -0,0 +1,622 @@
+"""Concurrent load test for the SAP Assistant chat flow.
+
+Drives N simulated sessions through the chat flow: Anthropic tool call ->
+retrieve_errors -> fallback suggestion -> escalation -> raise_log. The
+Anthropic API and the helpdesk endpoint are replaced by local fake HTTP
+servers with configurable latency, so the numbers reflect the app itself and
+can be used to size a deployment.
+
+Two modes:
+  threads   (default) sessions run as threads of one process calling
+            run_chat_turn/raise_log directly, the way Streamlit serves every
+            session of a server process, so they share the process-wide rate
+            limiter, breaker, speculation pool and escalation coalescer.
+  apptest   each session runs my_app.py end to end through AppTest in its own
+            worker process (AppTest is not thread-safe), so nothing is shared.
+Both modes start with one AppTest session as an end-to-end check.
+
+Usage:
+    python load_test.py --sessions 50 --concurrency 10 --llm-latency-ms 600
+    python load_test.py --mode apptest --sessions 20 --concurrency 5
+"""
+import argparse
+import ast
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(BASE_DIR, "my_app.py")
+ERRORS_JSON = os.path.join(BASE_DIR, "data", "errors.json")
+
+# Same keywords the system prompt tells the model to treat as explicit errors
+ERROR_KEYWORDS = re.compile(r"error|blocked|not found|missing|failed|does not exist|not in", re.IGNORECASE)
+
+# Prompts that should not match anything in the KB (exercise the fallback suggestion path)
+NO_MATCH_PROMPTS = [
+    "Workflow item 88812 failed with an unknown status",
+    "Printer output for billing doc 90001234 failed",
+]
+ESCALATION_REPLY = "Yes, please raise a ticket"
+# First entries of company.json, what the escalation form's selectboxes default to
+FORM_COMPANY_CODE = "490518"
+FORM_PROFIT_CENTER = "3410"
+
+# How the fake model words its retrieve_errors call (style, weight). Real models do not
+# always pass the prompt verbatim, and speculation only pays off when they do (or pass
+# the extracted phrase), so the hit rate in the report depends on this mix.
+TOOL_ARG_STYLES = [("prompt", 0.55), ("phrase", 0.2), ("rephrased", 0.1), ("company", 0.15)]
+
+# ------------------------------------------------------------------
+# 1. METRICS
+# ------------------------------------------------------------------
+_stats_lock = threading.Lock()
+STAGE_TIMINGS = defaultdict(list)
+STAGE_ERRORS = Counter()
+SPECULATION_TOTALS = Counter()
+SPECULATION_COUNTERS = ("started", "hits", "misses", "unused", "saved_seconds")
+RATE_LIMIT_TOTALS = Counter()
+RATE_LIMIT_COUNTERS = ("granted", "queued", "timeouts", "throttled_by_provider")
+
+
+def record(stage, seconds, ok=True):
+    """Record one latency sample (and optionally a failure) for a stage."""
+    with _stats_lock:
+        STAGE_TIMINGS[stage].append(seconds)
+        if not ok:
+            STAGE_ERRORS[stage] += 1
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def timed(stage, func):
+    """Wrap func so every call is recorded under stage."""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = func(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            record(stage, time.perf_counter() - start, ok)
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+def timed_async(stage, func):
+    """Async counterpart of timed() for coroutine functions."""
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = await func(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            record(stage, time.perf_counter() - start, ok)
+    wrapper.__wrapped__ = func
+    return wrapper
+
+
+# ------------------------------------------------------------------
+# 2. FAKE SERVERS
+# ------------------------------------------------------------------
+def _sleep_latency(mean_ms, jitter_ms):
+    time.sleep(max(0.0, random.gauss(mean_ms, jitter_ms)) / 1000.0)
+
+
+def fake_tool_input(user_text):
+    """retrieve_errors arguments in one of TOOL_ARG_STYLES, picked at random."""
+    style = random.choices([name for name, _ in TOOL_ARG_STYLES], [weight for _, weight in TOOL_ARG_STYLES])[0]
+    if style == "phrase":
+        from agents.retrieval_new import extract_error_phrase
+        return {"user_input": extract_error_phrase(user_text) or user_text}
+    if style == "rephrased":
+        return {"user_input": f"Getting this in SAP: {user_text}"}
+    if style == "company":
+        return {"user_input": user_text, "company_code": "490518"}
+    return {"user_input": user_text}
+
+
+class FakeAnthropicHandler(BaseHTTPRequestHandler):
+    """Minimal /v1/messages endpoint: tool_use for error-like prompts, text otherwise."""
+    latency_ms = 500
+    jitter_ms = 100
+    error_rate = 0.0
+    counter = 0
+    counter_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass  # keep the report readable
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client gave up (turn deadline / timeout)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        _sleep_latency(self.latency_ms, self.jitter_ms)
+
+        with self.counter_lock:
+            FakeAnthropicHandler.counter += 1
+            message_no = FakeAnthropicHandler.counter
+
+        if random.random() < self.error_rate:
+            self._send_json(500, {"type": "error", "error": {"type": "api_error", "message": "Injected failure"}})
+            return
+
+        messages = request.get("messages", [])
+        user_text = messages[-1]["content"] if messages else ""
+        if isinstance(user_text, list):
+            user_text = " ".join(part.get("text", "") for part in user_text if isinstance(part, dict))
+
+        if request.get("tools") and ERROR_KEYWORDS.search(user_text):
+            content = [{
+                "type": "tool_use",
+                "id": f"toolu_fake_{message_no}",
+                "name": "retrieve_errors",
+                "input": fake_tool_input(user_text)
+            }]
+            stop_reason = "tool_use"
+        else:
+            content = [{"type": "text", "text": "Check the master data in the relevant transaction (e.g. MM03, XK03) and your authorizations."}]
+            stop_reason = "end_turn"
+
+        self._send_json(200, {
+            "id": f"msg_fake_{message_no}",
+            "type": "message",
+            "role": "assistant",
+            "model": request.get("model", "fake"),
+            "content": content,
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": {"input_tokens": 100, "output_tokens": 50}
+        })
+
+
+class FakeHelpdeskHandler(BaseHTTPRequestHandler):
+    """Mimics the helpdesk ORDS API: JSON body with a nested JSON 'response' string."""
+    latency_ms = 300
+    jitter_ms = 50
+    counter = 0
+    counter_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        _sleep_latency(self.latency_ms, self.jitter_ms)
+        with self.counter_lock:
+            FakeHelpdeskHandler.counter += 1
+            issue_number = 100000 + FakeHelpdeskHandler.counter
+        body = json.dumps({
+            "response": json.dumps({"issue_number": issue_number, "zhi_id": f"ZHI{issue_number}"})
+        }).encode("utf-8")
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(handler):
+    """Start a threaded HTTP server on a free local port and return it."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ------------------------------------------------------------------
+# 3. SIMULATED SESSION
+# ------------------------------------------------------------------
+def load_prompts():
+    """Build user prompts from the KB issue names plus a few guaranteed misses."""
+    prompts = []
+    try:
+        with open(ERRORS_JSON, 'r', encoding='utf-8') as f:
+            for error in json.load(f):
+                name = error.get("issuename") or ""
+                prompts.append(name.replace("XXXX", "1000738").replace("YYYY", "NG70"))
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        print(f"Warning: could not load {ERRORS_JSON} ({e}), using fallback prompts only")
+    return [p for p in prompts if p] + NO_MATCH_PROMPTS
+
+
+
+def _app_failed(at):
+    return bool(at.exception) or any("API Error" in e.value for e in at.error)
+
+
+def _has_escalation_form(at):
+    return any(t.key == "contact_no" for t in at.text_input)
+
+
+def instrument_app(env, log_path):
+    """Point the app at the fakes and wrap its stages with timers (once per process)."""
+    os.environ.update(env)  # before agents.log_raiser reads HELPDESK_API_ENDPOINT
+    sys.path.insert(0, BASE_DIR)
+
+    import agents.log_raiser as log_raiser
+    import agents.retrieval_new as retrieval_new
+    from anthropic.resources.messages import AsyncMessages
+
+    # Keep load-test tickets out of the real data/logs.json
+    log_raiser.LOG_PATH = log_path
+
+    # Patched before my_app.py (and agents.chat_core) first import these names, so the app picks them up
+    retrieval_new.retrieve_errors = timed("retrieve_errors", retrieval_new.retrieve_errors)
+    log_raiser.raise_log = timed("raise_log", log_raiser.raise_log)
+    AsyncMessages.create = timed_async("llm_call", AsyncMessages.create)
+
+
+def init_worker(env, log_path, verbose):
+    """Prepare an AppTest worker process.
+
+    AppTest sessions run in separate processes because AppTest is not
+    thread-safe (it swaps a global Runtime singleton per run), so
+    concurrency == worker count.
+    """
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')  # the app prints a lot of debug output
+    instrument_app(env, log_path)
+
+
+def load_app_constants():
+    """SYSTEM_PROMPT and tools from my_app.py; importing it would run the Streamlit script."""
+    with open(APP_PATH, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            if node.targets[0].id in ("SYSTEM_PROMPT", "tools"):
+                constants[node.targets[0].id] = ast.literal_eval(node.value)
+    return constants["SYSTEM_PROMPT"], constants["tools"]
+
+
+def run_thread_session(session_no, prompt, client, system_prompt, tools):
+    """Drive one user the way my_app.py does, calling the agents directly; returns ok.
+
+    Runs on a thread of the load-test process, so all sessions share its singletons.
+    """
+    from agents.chat_core import run_chat_turn
+    from agents.log_raiser import raise_log
+    from agents.retrieval_new import extract_error_phrase
+
+    ok = False
+    session_start = time.perf_counter()
+    try:
+        start = time.perf_counter()
+        replies = run_chat_turn(client, prompt, system_prompt, tools)
+        failed = any("error" in reply for reply in replies)
+        record("chat_turn", time.perf_counter() - start, not failed)
+
+        state = {}
+        for reply in replies:
+            state.update(reply.get("state", {}))
+        details = state.get("pending_details")
+        if not failed and not details:
+            # No match / consult path: the user replies ESCALATION_REPLY and my_app's
+            # escalation-intent branch escalates the last error (or the reply itself)
+            user_input = state.get("last_user_error") or ESCALATION_REPLY
+            details = {
+                "user_input": user_input,
+                "matches": state.get("last_matches") or [{
+                    "id": None, "module": "Unknown", "issuename": "No matching error found",
+                    "issuedescription": user_input, "solution": "Sorry no match found",
+                    "solutiontype": "consult", "logcategory": None, "logsubcategory": None,
+                    "notes": None, "score": 0
+                }],
+                "extracted_phrase": extract_error_phrase(user_input)
+            }
+
+        if details:
+            details = dict(details, contact_no="08000000000", mail_id=f"load.user{session_no}@tolaram.com",
+                           cc_to="", company_code=FORM_COMPANY_CODE, profit_center=FORM_PROFIT_CENTER)
+            start = time.perf_counter()
+            # Also "success" when linked to another user's ticket by escalation coalescing
+            ok = raise_log(details)["status"] == "success"
+            record("escalation_submit", time.perf_counter() - start, ok)
+    except Exception as e:
+        sys.stderr.write(f"Session {session_no} failed: {e}\n")
+    record("session", time.perf_counter() - session_start, ok)
+    return ok
+
+
+def collect_shared_stats():
+    """Speculation and rate-limiter counters of this process (threads mode)."""
+    from agents.speculation import speculation_stats
+    from agents.rate_limiter import rate_limiter_stats
+
+    speculation = {name: value for name, value in speculation_stats().items() if name in SPECULATION_COUNTERS}
+    limiter = rate_limiter_stats()
+    for waited in limiter["recent_waits"]:  # the limiter keeps the last 500
+        record("rate_limit_wait", waited)
+    rate_limit = {name: limiter[name] for name in RATE_LIMIT_COUNTERS}
+    rate_limit["max_queue_depth"] = limiter["max_queue_depth"]
+    merge_stats({}, {}, speculation, rate_limit)
+
+
+def run_session(session_no, prompt, timeout):
+    """Drive one user through chat -> (optional) escalation intent -> escalation form.
+
+    Returns (ok, timings, errors, speculation, rate_limit) for this session so the parent can merge them.
+    """
+    from streamlit.testing.v1 import AppTest
+    from agents.speculation import reset_speculation_stats, speculation_stats
+    from agents.rate_limiter import reset_rate_limiter_stats, rate_limiter_stats
+
+    with _stats_lock:
+        STAGE_TIMINGS.clear()
+        STAGE_ERRORS.clear()
+    reset_speculation_stats()
+    reset_rate_limiter_stats()
+
+    ok = False
+    session_start = time.perf_counter()
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    try:
+        at.run()
+
+        start = time.perf_counter()
+        at.chat_input[0].set_value(prompt).run()
+        record("chat_turn", time.perf_counter() - start, not _app_failed(at))
+
+        if not _app_failed(at) and not _has_escalation_form(at):
+            # No match / consult path: user accepts the offer to escalate (intent regex)
+            start = time.perf_counter()
+            at.chat_input[0].set_value(ESCALATION_REPLY).run()
+            record("escalation_intent", time.perf_counter() - start, _has_escalation_form(at))
+
+        if not _app_failed(at) and _has_escalation_form(at):
+            at.text_input(key="contact_no").input("08000000000")
+            at.text_input(key="mail_id").input(f"load.user{session_no}@tolaram.com")
+            start = time.perf_counter()
+            at.button[0].click().run()
+            # "Already reported" = linked to another user's ticket by escalation coalescing
+            ok = any("Log created" in m.value or "Already reported" in m.value for m in at.markdown)
+            record("escalation_submit", time.perf_counter() - start, ok)
+    except Exception as e:
+        sys.stderr.write(f"Session {session_no} failed: {e}\n")
+    record("session", time.perf_counter() - session_start, ok)
+
+    speculation = {name: value for name, value in speculation_stats().items() if name in SPECULATION_COUNTERS}
+    limiter = rate_limiter_stats()
+    # Queue waits become their own stage so they get the same percentiles as everything else
+    for waited in limiter["recent_waits"]:
+        record("rate_limit_wait", waited)
+    rate_limit = {name: limiter[name] for name in RATE_LIMIT_COUNTERS}
+    rate_limit["max_queue_depth"] = limiter["max_queue_depth"]
+    with _stats_lock:
+        return ok, dict(STAGE_TIMINGS), dict(STAGE_ERRORS), speculation, rate_limit
+
+
+def merge_stats(timings, errors, speculation, rate_limit):
+    with _stats_lock:
+        for stage, samples in timings.items():
+            STAGE_TIMINGS[stage].extend(samples)
+        STAGE_ERRORS.update(errors)
+        SPECULATION_TOTALS.update(speculation)
+        RATE_LIMIT_TOTALS.update({name: rate_limit[name] for name in RATE_LIMIT_COUNTERS})
+        RATE_LIMIT_TOTALS["max_queue_depth"] = max(RATE_LIMIT_TOTALS["max_queue_depth"], rate_limit["max_queue_depth"])
+
+
+# ------------------------------------------------------------------
+# 4. REPORT
+# ------------------------------------------------------------------
+def build_report(mode, elapsed, sessions_ok, sessions_total):
+    with _stats_lock:
+        stages = {
+            stage: {
+                "count": len(samples),
+                "errors": STAGE_ERRORS[stage],
+                "error_rate": STAGE_ERRORS[stage] / len(samples) if samples else 0.0,
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p95_ms": percentile(samples, 95) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+                "max_ms": max(samples) * 1000 if samples else 0.0
+            }
+            for stage, samples in sorted(STAGE_TIMINGS.items())
+        }
+        speculation = {name: SPECULATION_TOTALS[name] for name in SPECULATION_COUNTERS}
+        rate_limit = {name: RATE_LIMIT_TOTALS[name] for name in RATE_LIMIT_COUNTERS + ("max_queue_depth",)}
+    tool_calls = speculation["hits"] + speculation["misses"]
+    speculation["hit_rate"] = speculation["hits"] / tool_calls if tool_calls else 0.0
+    speculation["avg_saved_ms"] = speculation["saved_seconds"] / speculation["hits"] * 1000 if speculation["hits"] else 0.0
+    turns = sum(stages.get(s, {}).get("count", 0) for s in ("chat_turn", "escalation_intent", "escalation_submit"))
+    return {
+        "mode": mode,
+        "elapsed_s": elapsed,
+        "sessions": sessions_total,
+        "sessions_ok": sessions_ok,
+        "session_error_rate": (sessions_total - sessions_ok) / sessions_total if sessions_total else 0.0,
+        "throughput_sessions_per_s": sessions_total / elapsed if elapsed else 0.0,
+        "throughput_turns_per_s": turns / elapsed if elapsed else 0.0,
+        "llm_requests": FakeAnthropicHandler.counter,
+        "helpdesk_requests": FakeHelpdeskHandler.counter,
+        "speculation": speculation,
+        "rate_limit": rate_limit,
+        "stages": stages
+    }
+
+
+def print_report(report):
+    print(f"\n=== SAP Assistant load test ({report['mode']} mode) ===")
+    print(f"Sessions: {report['sessions_ok']}/{report['sessions']} ok "
+          f"(error rate {report['session_error_rate']:.1%}) in {report['elapsed_s']:.1f}s")
+    print(f"Throughput: {report['throughput_sessions_per_s']:.2f} sessions/s, "
+          f"{report['throughput_turns_per_s']:.2f} turns/s")
+    print(f"Fake API calls: {report['llm_requests']} LLM, {report['helpdesk_requests']} helpdesk")
+    spec = report["speculation"]
+    print(f"Speculative retrieval: {spec['hits']} hits / {spec['hits'] + spec['misses']} tool calls "
+          f"({spec['hit_rate']:.0%}), {spec['unused']} unused, avg {spec['avg_saved_ms']:.1f} ms saved per hit")
+    limit = report["rate_limit"]
+    scope = "per worker" if report["mode"] == "apptest" else "shared"
+    print(f"Rate limiter: {limit['granted']} granted, {limit['queued']} queued, {limit['timeouts']} timed out, "
+          f"{limit['throttled_by_provider']} provider 429s, max queue depth {limit['max_queue_depth']} "
+          f"({scope}; waits under rate_limit_wait)")
+    print(f"\n{'stage':<20}{'count':>7}{'err%':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, s in report["stages"].items():
+        print(f"{stage:<20}{s['count']:>7}{s['error_rate'] * 100:>7.1f}%"
+              f"{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}{s['max_ms']:>10.1f}")
+
+
+# ------------------------------------------------------------------
+# 5. MAIN
+# ------------------------------------------------------------------
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent load test for my_app.py with fake LLM and helpdesk.")
+    parser.add_argument("--mode", choices=("threads", "apptest"), default="threads",
+                        help="threads: sessions share one process; apptest: one AppTest worker process per session")
+    parser.add_argument("--sessions", type=int, default=20, help="total simulated user sessions")
+    parser.add_argument("--concurrency", type=int, default=5,
+                        help="sessions running at the same time (threads, or worker processes in apptest mode)")
+    parser.add_argument("--llm-latency-ms", type=float, default=500, help="mean fake Anthropic latency")
+    parser.add_argument("--llm-jitter-ms", type=float, default=100, help="std-dev of fake Anthropic latency")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="fraction of fake Anthropic calls returning 500")
+    parser.add_argument("--helpdesk-latency-ms", type=float, default=300, help="mean fake helpdesk latency")
+    parser.add_argument("--helpdesk-jitter-ms", type=float, default=50, help="std-dev of fake helpdesk latency")
+    parser.add_argument("--timeout", type=float, default=60, help="per-run AppTest timeout in seconds (apptest mode)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for prompt selection")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show the app's debug output")
+    return parser.parse_args(argv)
+
+
+def run_apptest(args, context, initargs, prompts):
+    with ProcessPoolExecutor(max_workers=args.concurrency, mp_context=context,
+                             initializer=init_worker, initargs=initargs) as pool:
+        # Spin every worker up (imports, AppTest) before the clock starts
+        list(pool.map(time.sleep, [0.5] * args.concurrency))
+        start = time.perf_counter()
+        futures = [
+            pool.submit(run_session, i + 1, random.choice(prompts), args.timeout)
+            for i in range(args.sessions)
+        ]
+        results = []
+        for future in futures:
+            ok, timings, errors, speculation, rate_limit = future.result()
+            merge_stats(timings, errors, speculation, rate_limit)
+            results.append(ok)
+        return time.perf_counter() - start, results
+
+
+def run_threads(args, env, log_path, prompts):
+    instrument_app(env, log_path)
+    from agents.chat_core import get_client
+    from agents.speculation import reset_speculation_stats
+    from agents.rate_limiter import reset_rate_limiter_stats
+
+    system_prompt, tools = load_app_constants()
+    client = get_client(env["ANTHROPIC_API_KEY"])
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    with quiet:
+        # Imports, KB snapshot and the chat core loop come up before the clock starts
+        run_thread_session(0, prompts[0], client, system_prompt, tools)
+        with _stats_lock:
+            STAGE_TIMINGS.clear()
+            STAGE_ERRORS.clear()
+        reset_speculation_stats()
+        reset_rate_limiter_stats()
+        FakeAnthropicHandler.counter = 0
+        FakeHelpdeskHandler.counter = 0
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            start = time.perf_counter()
+            futures = [
+                pool.submit(run_thread_session, i + 1, random.choice(prompts), client, system_prompt, tools)
+                for i in range(args.sessions)
+            ]
+            results = [future.result() for future in futures]
+            elapsed = time.perf_counter() - start
+    collect_shared_stats()
+    return elapsed, results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+
+    FakeAnthropicHandler.latency_ms = args.llm_latency_ms
+    FakeAnthropicHandler.jitter_ms = args.llm_jitter_ms
+    FakeAnthropicHandler.error_rate = args.llm_error_rate
+    FakeHelpdeskHandler.latency_ms = args.helpdesk_latency_ms
+    FakeHelpdeskHandler.jitter_ms = args.helpdesk_jitter_ms
+    llm_server = start_server(FakeAnthropicHandler)
+    helpdesk_server = start_server(FakeHelpdeskHandler)
+
+    env = {
+        "ANTHROPIC_API_KEY": "load-test",
+        "ANTHROPIC_BASE_URL": f"http://127.0.0.1:{llm_server.server_address[1]}",
+        "HELPDESK_API_ENDPOINT": f"http://127.0.0.1:{helpdesk_server.server_address[1]}/issues"
+    }
+    log_path = os.path.join(tempfile.mkdtemp(prefix="sap_load_test_"), "logs.json")
+    print(f"Fake Anthropic: {env['ANTHROPIC_BASE_URL']}, fake helpdesk: {env['HELPDESK_API_ENDPOINT']}")
+    print(f"Load-test tickets are logged to {log_path}")
+
+    prompts = load_prompts()
+    context = multiprocessing.get_context("spawn")
+    initargs = (env, log_path, args.verbose)
+
+    # One AppTest session up front: the end-to-end check of my_app.py itself, and it
+    # creates data/errors.db before workers race for it
+    print("Warming up (end-to-end AppTest session)...")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=init_worker, initargs=initargs) as pool:
+        if not pool.submit(run_session, 0, prompts[0], args.timeout).result()[0]:
+            print("Warning: the end-to-end AppTest session did not complete its escalation")
+    FakeAnthropicHandler.counter = 0
+    FakeHelpdeskHandler.counter = 0
+
+    print(f"Running {args.sessions} sessions with concurrency {args.concurrency} ({args.mode} mode)...")
+    if args.mode == "threads":
+        elapsed, results = run_threads(args, env, log_path, prompts)
+    else:
+        elapsed, results = run_apptest(args, context, initargs, prompts)
+
+    report = build_report(args.mode, elapsed, sum(results), len(results))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"\nReport written to {args.json_path}")
+
+    llm_server.shutdown()
+    helpdesk_server.shutdown()
+    return 0 if report["sessions_ok"] == report["sessions"] else 1
+
+
+if __name__ == "__main__":
+    # AppTest executes my_app.py as __main__ inside the workers, so anything pickled
+    # by reference must live in the importable load_test module, not in __main__.
+    sys.path.insert(0, BASE_DIR)
+    import load_test
+    sys.exit(load_test.main())
@@ -4,10 +4,10 @@ import re
 import json
 import sqlite3
 from dotenv import load_dotenv
-from anthropic import Anthropic, AnthropicError
 from datetime import datetime
-from agents.retrieval_new import retrieve_errors, extract_error_phrase
+from agents.retrieval_new import extract_error_phrase, ensure_kb_snapshot
 from agents.log_raiser import raise_log
+from agents.chat_core import get_client, run_chat_turn
 
 # ------------------------------------------------------------------
 # 1. PATHS – always absolute, works locally AND on Streamlit Cloud
@@ -97,6 +97,8 @@ def init_db():
 
 # Run DB init **once** at app start
 init_db()
+# Normally prebuilt by the deploy step (python -m agents.kb_snapshot); rebuilt here if missing/stale
+ensure_kb_snapshot()
 
 # ------------------------------------------------------------------
 # 3. LOAD COMPANY DATA (fallback if file missing)
@@ -123,7 +125,7 @@ if not ANTHROPIC_API_KEY:
     st.error("Anthropic API key not found. Add it in Streamlit Secrets or .env.")
     st.stop()
 
-client = Anthropic(api_key=ANTHROPIC_API_KEY)
+client = get_client(ANTHROPIC_API_KEY)
 
 # ------------------------------------------------------------------
 # 5. TOOLS (unchanged)
@@ -236,98 +238,23 @@ if prompt := st.chat_input("Type your SAP error or message"):
             st.markdown("Okay, let's get started with raising a log ticket for your issue. Could you please provide me with the details I'll need to escalate this?")
             st.session_state.messages.append({"role": "assistant", "content": "Okay, let's get started with raising a log ticket for your issue. Could you please provide me with the details I'll need to escalate this?"})
     else:
-        # --- Normal Anthropic call ---
+        # --- Normal Anthropic call (async core: tool calls + fallbacks run concurrently) ---
         print("Debug: Calling Anthropic API.")
         with st.chat_message("assistant"):
             try:
-                response = client.messages.create(
-                    model="claude-3-haiku-20240307",
-                    max_tokens=500,
-                    temperature=0.7,
-                    system=SYSTEM_PROMPT,
-                    messages=[{"role": "user", "content": prompt}],
-                    tools=tools
-                )
-                print(f"Debug: Anthropic response: {response}")
-
-                for block in response.content:
-                    if block.type == "tool_use":
-                        tool_name = block.name
-                        tool_input = block.input
-                        print(f"Debug: Tool call → {tool_name}: {tool_input}")
-
-                        if tool_name == "retrieve_errors":
-                            try:
-                                result = retrieve_errors(**tool_input)
-                                if isinstance(result, list) and result:
-                                    result = sorted(result, key=lambda x: x["score"], reverse=True)
-                                    st.session_state.last_matches = result
-                                    st.session_state.last_user_error = tool_input["user_input"]
-                                    top = result[0]
-
-                                    if top.get("solutiontype", "").lower() in ["", "consult", "user guidance"]:
-                                        suggestion_resp = client.messages.create(
-                                            model="claude-3-haiku-20240307",
-                                            max_tokens=200,
-                                            temperature=0.7,
-                                            system="You are an SAP consultant. Provide 1-2 concise, practical suggestions (transaction codes, checks, steps). Do NOT mention databases or escalation.",
-                                            messages=[{"role": "user", "content": f"User query: {prompt}"}]
-                                        )
-                                        suggestion = suggestion_resp.content[0].text if suggestion_resp.content else "Check relevant transaction codes or master data."
-                                        txt = f"Sorry, I couldn’t find a match in my database. Based on my SAP expertise: {suggestion} Would you like to escalate?"
-                                        st.markdown(txt)
-                                        st.session_state.messages.append({"role": "assistant", "content": txt})
-
-                                    elif "escalation" in top.get("solutiontype", "").lower():
-                                        extracted = extract_error_phrase(prompt)
-                                        st.session_state.pending_details = {
-                                            "user_input": prompt,
-                                            "matches": result,
-                                            "extracted_phrase": extracted
-                                        }
-                                        st.markdown(f"**Try this first:**\n\n{top['solution']}\n\n**Still needs escalation.** Please provide contact details.")
-                                        st.session_state.messages.append({"role": "assistant", "content": "This issue requires escalation. Please provide contact details."})
-
-                                    else:
-                                        st.markdown(f"Looks like you're facing **{top['issuename']}**. Here's how to resolve it:\n\n{top['solution']}")
-                                        st.session_state.messages.append({"role": "assistant", "content": f"Looks like you're facing **{top['issuename']}**. Here's how to resolve it:\n\n{top['solution']}"})
-                                else:
-                                    # No match → LLM suggestion
-                                    suggestion_resp = client.messages.create(
-                                        model="claude-3-haiku-20240307",
-                                        max_tokens=200,
-                                        temperature=0.7,
-                                        system="You are an SAP consultant. Provide 1-2 concise, practical suggestions. No mention of DB/escalation.",
-                                        messages=[{"role": "user", "content": f"User query: {prompt}"}]
-                                    )
-                                    suggestion = suggestion_resp.content[0].text if suggestion_resp.content else "Check transaction codes or master data."
-                                    txt = f"Sorry, no match found. Based on my SAP expertise: {suggestion} Would you like to escalate?"
-                                    st.markdown(txt)
-                                    st.session_state.messages.append({"role": "assistant", "content": txt})
-                                    st.session_state.last_matches = None
-                                    st.session_state.last_user_error = None
-
-                            except Exception as e:
-                                print(f"Debug: retrieve_errors error: {e}")
-                                suggestion_resp = client.messages.create(
-                                    model="claude-3-haiku-20240307",
-                                    max_tokens=200,
-                                    temperature=0.7,
-                                    system="You are an SAP consultant. Provide 1-2 concise suggestions.",
-                                    messages=[{"role": "user", "content": f"User query: {prompt}"}]
-                                )
-                                suggestion = suggestion_resp.content[0].text if suggestion_resp.content else "Check relevant T-codes."
-                                txt = f"Error searching DB. Suggestion: {suggestion} Escalate?"
-                                st.markdown(txt)
-                                st.session_state.messages.append({"role": "assistant", "content": txt})
-
-                    elif block.type == "text":
-                        st.markdown(block.text)
-                        st.session_state.messages.append({"role": "assistant", "content": block.text})
-
-            except AnthropicError as e:
-                st.error(f"API Error: {e}")
-                st.session_state.messages.append({"role": "assistant", "content": f"Error: {e}"})
+                replies = run_chat_turn(client, prompt, SYSTEM_PROMPT, tools)
+            except Exception as e:  # e.g. concurrent.futures.TimeoutError if the core loop is wedged
+                print(f"Debug: chat turn failed: {e!r}")
+                replies = [{"error": str(e) or "the assistant took too long to respond"}]
+            for reply in replies:
+                if "error" in reply:
+                    st.error(f"API Error: {reply['error']}")
+                    st.session_state.messages.append({"role": "assistant", "content": f"Error: {reply['error']}"})
+                    continue
+                for key, value in reply["state"].items():
+                    st.session_state[key] = value
+                st.markdown(reply["markdown"])
+                st.session_state.messages.append({"role": "assistant", "content": reply["history"]})
 
 # ------------------------------------------------------------------
 # 10. ESCALATION FORM (unchanged logic)
@@ -357,8 +284,13 @@ if st.session_state.pending_details:
                 with st.chat_message("assistant"):
                     try:
                         result = raise_log(details)
-                        st.markdown(f"**Log created!** Ticket: `{result['response'].get('issue_number')}`, zHI: `{result['response'].get('zhi_id')}`")
-                        st.session_state.messages.append({"role": "assistant", "content": f"Log created! Ticket: {result['response'].get('issue_number')}, zHI: {result['response'].get('zhi_id')}"})
+                        if result['response'].get('coalesced'):
+                            # Same issue already escalated by another user – linked to their ticket
+                            st.markdown(f"**Already reported!** This issue is being handled under Ticket: `{result['response'].get('issue_number')}`, zHI: `{result['response'].get('zhi_id')}`. Your escalation has been linked to that ticket.")
+                            st.session_state.messages.append({"role": "assistant", "content": f"Already reported! Ticket: {result['response'].get('issue_number')}, zHI: {result['response'].get('zhi_id')}"})
+                        else:
+                            st.markdown(f"**Log created!** Ticket: `{result['response'].get('issue_number')}`, zHI: `{result['response'].get('zhi_id')}`")
+                            st.session_state.messages.append({"role": "assistant", "content": f"Log created! Ticket: {result['response'].get('issue_number')}, zHI: {result['response'].get('zhi_id')}"})
                         st.session_state.pending_details = None
                         st.session_state.last_matches = None
                         st.session_state.last_user_error = None